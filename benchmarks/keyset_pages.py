@@ -0,0 +1,86 @@
+"""
+Shows the query plans and timings of resumed pages in
+SQLDatabase.oai_query at several depths, in both orders. With keyset
+pagination the cost of a page should not grow with its depth, the
+timings of an OFFSET query are shown for comparison.
+
+usage: python benchmarks/keyset_pages.py [records] [database uri]
+"""
+import sys
+import time
+import datetime
+
+from moai.database import SQLDatabase, HEADER_FIELDS
+
+DEPTHS = [0.0005, 0.5, 0.999]
+REPEAT = 5
+PAGE_SIZE = 100
+
+def fill(db, count):
+    start = datetime.datetime(2000, 1, 1)
+    for i in range(count):
+        # a few records share a datestamp, so the record_id tie breaker
+        # is used as well
+        db.update_record(u'oai:record-%s' % i,
+                         start + datetime.timedelta(minutes=i / 3),
+                         False, {}, {u'title': [u'Record %s' % i]})
+        if i % 10000 == 0:
+            db.flush()
+    db.flush()
+
+def keys(db, order):
+    records = db._records
+    return [tuple(row) for row in db._oai_select(
+        fields=HEADER_FIELDS, order=order).with_only_columns(
+        [records.c.modified, records.c.record_id]).execute()]
+
+def explain(db, query):
+    engine = db._db.bind
+    if engine.dialect.name != 'sqlite':
+        return ['(plans are only shown for sqlite)']
+    compiled = query.compile(bind=engine)
+    params = compiled.construct_params()
+    rows = engine.execute('EXPLAIN QUERY PLAN %s' % compiled,
+                          tuple([params[name]
+                                 for name in compiled.positiontup]))
+    return [list(row)[-1] for row in rows]
+
+def timed(query):
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        query.execute().fetchall()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return '%.2f ms' % (best * 1000)
+
+def main():
+    count = 200000
+    uri = None
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        uri = sys.argv[2]
+    db = SQLDatabase(uri)
+    fill(db, count)
+    print 'records: %s, page size: %s' % (count, PAGE_SIZE)
+    for order in ['desc', 'asc']:
+        ordered = keys(db, order)
+        print
+        print '=== %s ===' % order
+        for depth in DEPTHS:
+            position = int(len(ordered) * depth)
+            query = db._oai_select(fields=HEADER_FIELDS, order=order,
+                                   after=ordered[position - 1]
+                                   ).limit(PAGE_SIZE)
+            offset = db._oai_select(fields=HEADER_FIELDS, order=order
+                                    ).offset(position).limit(PAGE_SIZE)
+            print 'page at %s:' % position
+            for line in explain(db, query):
+                print '    %s' % line
+            print '    keyset: %s, offset: %s' % (timed(query),
+                                                  timed(offset))
+
+if __name__ == '__main__':
+    main()
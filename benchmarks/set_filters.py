@@ -0,0 +1,122 @@
+"""
+Compares the query plans and timings of the set filters in
+SQLDatabase.oai_query with the previous implementation, which joined one
+setrefs alias per set and removed the duplicates with DISTINCT.
+
+usage: python benchmarks/set_filters.py [records] [database uri]
+"""
+import sys
+import time
+import random
+import datetime
+
+import sqlalchemy as sql
+
+from moai.database import SQLDatabase, RECORD_FIELDS
+
+SET_COUNTS = [1, 5, 20]
+TOTAL_SETS = 40
+SETS_PER_RECORD = 3
+REPEAT = 5
+# queries that run longer than this are aborted (sqlite only)
+TIMEOUT = 10.0
+
+def legacy_select(db, allowed_sets):
+    records = db._records
+    query = records.select(order_by=[sql.desc(records.c.modified),
+                                     sql.desc(records.c.record_id)])
+    query.append_whereclause(
+        records.c.modified <= datetime.datetime.utcnow())
+    clauses = []
+    for set_id in allowed_sets:
+        alias = db._setrefs.alias()
+        sets_alias = db._sets.alias()
+        clauses.append(sql.and_(sets_alias.c.set_id == set_id,
+                                alias.c.set_id == sets_alias.c.id,
+                                alias.c.record_id == records.c.id))
+    query.append_whereclause(sql.or_(*clauses))
+    return query.distinct()
+
+def semijoin_select(db, allowed_sets):
+    return db._oai_select(allowed_sets=allowed_sets, fields=RECORD_FIELDS)
+
+def fill(db, count):
+    random.seed(42)
+    set_ids = [u'set%s' % i for i in range(TOTAL_SETS)]
+    start = datetime.datetime(2000, 1, 1)
+    for i in range(count):
+        sets = {}
+        for set_id in random.sample(set_ids, SETS_PER_RECORD):
+            sets[set_id] = {u'name': set_id}
+        db.update_record(u'oai:record-%s' % i,
+                         start + datetime.timedelta(minutes=i),
+                         False, sets, {u'title': [u'Record %s' % i]})
+        if i % 10000 == 0:
+            db.flush()
+    db.flush()
+    return set_ids
+
+def explain(db, query):
+    engine = db._db.bind
+    if engine.dialect.name != 'sqlite':
+        return ['(plans are only shown for sqlite)']
+    compiled = query.compile(bind=engine)
+    params = compiled.construct_params()
+    rows = engine.execute('EXPLAIN QUERY PLAN %s' % compiled,
+                          tuple([params[name]
+                                 for name in compiled.positiontup]))
+    return [list(row)[-1] for row in rows]
+
+def install_timeout(db, deadline):
+    engine = db._db.bind
+    if engine.dialect.name != 'sqlite':
+        return
+    connection = engine.raw_connection()
+    connection.connection.set_progress_handler(
+        lambda: time.time() > deadline[0], 100000)
+    connection.close()
+
+def timed(query, offset, deadline):
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        deadline[0] = start + TIMEOUT
+        try:
+            query.offset(offset).limit(100).execute().fetchall()
+        except sql.exc.OperationalError:
+            return 'aborted after %.0f ms' % (TIMEOUT * 1000)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return '%.2f ms' % (best * 1000)
+
+def main():
+    count = 20000
+    uri = None
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        uri = sys.argv[2]
+    db = SQLDatabase(uri)
+    set_ids = fill(db, count)
+    deadline = [None]
+    install_timeout(db, deadline)
+    print 'records: %s, sets: %s, sets per record: %s' % (
+        count, TOTAL_SETS, SETS_PER_RECORD)
+    for set_count in SET_COUNTS:
+        allowed_sets = set_ids[:set_count]
+        print
+        print '=== %s allowed set%s ===' % (set_count,
+                                           {1: ''}.get(set_count, 's'))
+        for name, select in [('alias joins + DISTINCT', legacy_select),
+                             ('semi-join', semijoin_select)]:
+            query = select(db, allowed_sets)
+            print '%s:' % name
+            for line in explain(db, query):
+                print '    %s' % line
+            print '    first page: %s, page at offset %s: %s' % (
+                timed(query, 0, deadline), count / 2,
+                timed(query, count / 2, deadline))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+moai.bitmap
+===========
+
+An in-process index of the set memberships of all records. Every
+record gets an ordinal, its position in (modified, record_id) order,
+and every set is stored as a bitmap of the ordinals of its records.
+Python longs are used as bitmaps, so combining sets is a single
+AND, OR or ANDNOT operation in C.
+"""
+import bisect
+import binascii
+
+class SetBitmapIndex(object):
+    """Bitmap index over the setrefs table, used by
+    :class:`moai.database.SQLDatabase` when the `set_index` option is set.
+
+    A built index is not changed anymore, the database builds a new
+    index when the records change, and replaces the old one.
+    """
+    def __init__(self):
+        self.valid = False
+        self._keys = []
+        self._modified = []
+        self._bitmaps = {}
+        self._all = 0
+
+    def build(self, records, setrefs):
+        """Builds the index from an iterable of (modified, record_id)
+        tuples, and an iterable of (record_id, set_id) tuples.
+
+        The records are sorted here, the keyset positions need python
+        ordering, which can differ from the collation of the database.
+        Building takes one pass over the setrefs, and creating a bitmap
+        of records / 8 bytes for every set.
+        """
+        keys = sorted([tuple(record) for record in records])
+        positions = dict([(key[1], position)
+                          for position, key in enumerate(keys)])
+        members = {}
+        for record_id, set_id in setrefs:
+            position = positions.get(record_id)
+            if position is not None:
+                members.setdefault(set_id, []).append(position)
+        # building a long from a hex string is linear, setting the bits
+        # of a long one by one would be quadratic
+        size = (len(keys) + 7) / 8
+        bitmaps = {}
+        for set_id, ordinals in members.items():
+            data = bytearray(size)
+            for ordinal in ordinals:
+                data[size - 1 - ordinal / 8] |= 1 << (ordinal % 8)
+            bitmaps[set_id] = long(binascii.hexlify(data), 16)
+        self._keys = keys
+        self._modified = [key[0] for key in keys]
+        self._bitmaps = bitmaps
+        self._all = (1L << len(keys)) - 1
+        self.valid = True
+
+    def invalidate(self):
+        self.valid = False
+
+    def candidates(self,
+                   needed_sets=None,
+                   disallowed_sets=None,
+                   allowed_sets=None,
+                   from_date=None,
+                   until_date=None,
+                   after=None,
+                   order='desc'):
+        """Returns the bitmap of all records matching the filters,
+        after is the last key of the previous page in the given order"""
+        bitmap = self._all
+        for set_id in needed_sets or []:
+            bitmap &= self._bitmaps.get(set_id, 0)
+        if allowed_sets:
+            bitmap &= self._union(allowed_sets)
+        if disallowed_sets:
+            bitmap &= ~self._union(disallowed_sets)
+
+        # date filters and the keyset become a range of ordinals
+        start = 0
+        stop = len(self._keys)
+        if from_date is not None:
+            start = bisect.bisect_left(self._modified, from_date)
+        if until_date is not None:
+            stop = bisect.bisect_right(self._modified, until_date)
+        if after is not None and order == 'asc':
+            start = max(start, bisect.bisect_right(self._keys, tuple(after)))
+        elif after is not None:
+            stop = min(stop, bisect.bisect_left(self._keys, tuple(after)))
+        if stop <= start:
+            return 0
+        return bitmap & ((1L << stop) - 1) & ~((1L << start) - 1)
+
+    def count(self, bitmap):
+        return bin(bitmap).count('1')
+
+    def select(self, bitmap, offset=0, limit=None, order='desc'):
+        """Returns the record ids of a bitmap in descending or
+        ascending (modified, record_id) order"""
+        if not bitmap:
+            return []
+        # the binary string starts with the highest ordinal
+        bits = bin(bitmap)[2:]
+        highest = len(bits) - 1
+        if order == 'asc':
+            position = len(bits)
+            def next_position(position):
+                return bits.rfind('1', 0, position)
+        else:
+            position = -1
+            def next_position(position):
+                return bits.find('1', position + 1)
+        ids = []
+        for i in xrange(offset):
+            position = next_position(position)
+            if position == -1:
+                return ids
+        while limit is None or len(ids) < limit:
+            position = next_position(position)
+            if position == -1:
+                break
+            ids.append(self._keys[highest - position][1])
+        return ids
+
+    def _union(self, set_ids):
+        bitmap = 0
+        for set_id in set_ids:
+            bitmap |= self._bitmaps.get(set_id, 0)
+        return bitmap
@@ -0,0 +1,158 @@
+"""
+moai.cache
+==========
+
+A bounded least recently used cache, used by
+:class:`moai.database.SQLDatabase` to keep decoded records in memory,
+and a cache of OAI-PMH responses used by :class:`moai.server.Server`.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Keeps the `size` most recently used values, and counts the
+    lookups that were found (hits) and not found (misses). It can be
+    shared by the threads of a threaded server.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # move the value to the end, the most recently used position
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._items),
+                    'maxsize': self.size}
+
+class ResponseCache(object):
+    """Keeps responses by request key for one database generation, in
+    a bounded :class:`LRUCache` and optionally in a directory that
+    several server processes can share. Responses of older generations
+    are never returned, and are removed when a newer generation is
+    stored.
+    """
+    def __init__(self, size, directory=None):
+        self.directory = directory
+        self._memory = None
+        if size > 0:
+            self._memory = LRUCache(size)
+        self._generation = None
+
+    def get(self, key, generation):
+        if self._memory is not None and generation == self._generation:
+            data = self._memory.get(key)
+            if data is not None:
+                return data
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key, generation), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        self._remember(key, generation, data)
+        return data
+
+    def put(self, key, generation, data):
+        self._remember(key, generation, data)
+        if self.directory is None:
+            return
+        generations = self._generations()
+        if generations and generation < max(generations):
+            # computed before another process changed the database
+            return
+        path = self._path(key, generation)
+        directory = os.path.dirname(path)
+        # caching is best effort, another process can remove the
+        # directory at any time
+        try:
+            if generation not in generations:
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created by another process
+                    pass
+                self._remove_generations(generation)
+            # other processes only see complete files
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.rename(temp_path, path)
+            except (IOError, OSError):
+                os.remove(temp_path)
+                raise
+        except (IOError, OSError):
+            pass
+
+    def _remember(self, key, generation, data):
+        if self._memory is None:
+            return
+        if self._generation is not None and generation < self._generation:
+            # computed before another process changed the database
+            return
+        if generation != self._generation:
+            self._memory.clear()
+            self._generation = generation
+        self._memory.put(key, data)
+
+    def _path(self, key, generation):
+        return os.path.join(self.directory, str(generation),
+                            hashlib.sha1(key).hexdigest())
+
+    def _generations(self):
+        # the generations that have a directory
+        if not os.path.isdir(self.directory):
+            return []
+        return [int(name) for name in os.listdir(self.directory)
+                if name.isdigit()]
+
+    def _remove_generations(self, generation):
+        # removes the directories of the generations before generation
+        for older in self._generations():
+            if older < generation:
+                shutil.rmtree(os.path.join(self.directory, str(older)),
+                              ignore_errors=True)
+
+    def info(self):
+        if self._memory is None:
+            return None
+        return self._memory.info()
@@ -0,0 +1,69 @@
+"""
+moai.codec
+==========
+
+Codecs that encode the metadata dictionaries of records for storage
+in the database. Codecs are registered under the `moai.codec` entry
+point group, the name of the entry point is used as the tag that is
+stored in front of every encoded value.
+
+Values without a tag are plain JSON, as written by older versions of
+MOAI, so existing databases can always be read.
+"""
+import base64
+import json
+import zlib
+
+from pkg_resources import iter_entry_points
+
+def get_codec(name):
+    for codec in iter_entry_points(group='moai.codec', name=name):
+        return codec.load()(name)
+    else:
+        raise ValueError('No such metadata codec registered: %s' % name)
+
+def date_handler(obj):
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    else:
+        raise TypeError, 'Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj))
+
+class JSONCodec(object):
+    """Stores the metadata as untagged JSON text.
+
+    This is the format used by all previous versions of MOAI, and
+    the default codec. It is registered under the name 'json'.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def encode(self, metadata):
+        return json.dumps(metadata, default=date_handler)
+
+    def decode(self, value):
+        return json.loads(value)
+
+class ZlibCodec(JSONCodec):
+    """Stores the metadata as zlib compressed JSON.
+
+    The compressed bytes are base64 encoded, so they can be stored in
+    the text column of existing databases. It is registered under the
+    name 'zlib'.
+    """
+    level = 6
+
+    def encode(self, metadata):
+        data = super(ZlibCodec, self).encode(metadata)
+        return '%s:%s' % (
+            self.name, base64.b64encode(zlib.compress(data, self.level)))
+
+    def decode(self, value):
+        return super(ZlibCodec, self).decode(
+            zlib.decompress(base64.b64decode(value.split(':', 1)[1])))
+
+def get_tag(value):
+    """Returns the codec tag of an encoded value, untagged values
+    are JSON dictionaries"""
+    if value.startswith('{'):
+        return 'json'
+    return value.split(':', 1)[0]
@@ -1,11 +1,34 @@
 import datetime
-import json
+import threading
 from pkg_resources import iter_entry_points
 
 import sqlalchemy as sql
+from sqlalchemy.engine.reflection import Inspector
+from paste.deploy.converters import asbool
 
+from moai.bitmap import SetBitmapIndex
+from moai.cache import LRUCache
+from moai.codec import get_codec, get_tag
+from moai.error import SchemaVersionError
 from moai.utils import check_type
 
+# version of the database schema, see migrate_database
+SCHEMA_VERSION = 2
+
+# all fields of a record returned by oai_query, and the fields needed to
+# create a header
+RECORD_FIELDS = ('id', 'modified', 'deleted', 'sets', 'metadata')
+HEADER_FIELDS = ('id', 'modified', 'deleted', 'sets')
+
+# maximum number of bind parameters used in a single IN clause, this
+# keeps us well below the limits of the supported databases
+IN_CLAUSE_SIZE = 500
+
+def chunked(items, size=IN_CLAUSE_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
 def get_database(uri, config=None):
     prefix = uri.split(':')[0]
     for entry_point in iter_entry_points(group='moai.database', name=prefix):
@@ -18,20 +41,219 @@ def get_database(uri, config=None):
     raise ValueError('No such database registered: %s' % prefix)
 
 
+def define_tables(db):
+    """Adds the tables of the current schema version to a MetaData"""
+    # records and sets have integer surrogate keys, the oai ids are
+    # unique columns. setrefs only stores pairs of integers.
+    records = sql.Table('records', db,
+              sql.Column('id', sql.Integer,
+                         sql.Sequence('records_id_seq', optional=True),
+                         primary_key=True),
+              sql.Column('record_id', sql.Unicode, nullable=False,
+                         unique=True),
+              sql.Column('modified', sql.DateTime, index=True),
+              sql.Column('deleted', sql.Boolean),
+              sql.Column('metadata', sql.String))
+    # composite index that matches the oai_query sort orders, so
+    # keyset pagination can seek directly to the next page
+    sql.Index('records_modified_record_id',
+              records.c.modified, records.c.record_id)
+
+    sql.Table('sets', db,
+              sql.Column('id', sql.Integer,
+                         sql.Sequence('sets_id_seq', optional=True),
+                         primary_key=True),
+              sql.Column('set_id', sql.Unicode, nullable=False,
+                         unique=True),
+              sql.Column('hidden', sql.Boolean),
+              sql.Column('name', sql.Unicode),
+              sql.Column('description', sql.Unicode))
+
+    sql.Table('setrefs', db,
+              sql.Column('record_id', sql.Integer,
+                         sql.ForeignKey('records.id'),
+                         index=True, primary_key=True),
+              sql.Column('set_id', sql.Integer,
+                         sql.ForeignKey('sets.id'),
+                         index=True, primary_key=True))
+
+    # the metadata of records serialized by the writer of a metadata
+    # prefix, stored by SQLDatabase.render_metadata
+    sql.Table('renditions', db,
+              sql.Column('record_id', sql.Integer,
+                         sql.ForeignKey('records.id'), primary_key=True),
+              sql.Column('prefix', sql.Unicode, primary_key=True),
+              sql.Column('xml', sql.String))
+
+    # the oai ids of the records that the renditions of a record show,
+    # like the contributors of MODS, so the renditions can be removed
+    # when those change
+    sql.Table('renditionrefs', db,
+              sql.Column('record_id', sql.Integer,
+                         sql.ForeignKey('records.id'), primary_key=True),
+              sql.Column('related_id', sql.Unicode, primary_key=True,
+                         index=True))
+
+    # the last change of every record, numbered in the order in which
+    # the changes were made. Removed records keep their row.
+    sql.Table('changes', db,
+              sql.Column('record_id', sql.Unicode, primary_key=True),
+              sql.Column('seq', sql.Integer, nullable=False,
+                         index=True, unique=True),
+              sql.Column('removed', sql.Boolean))
+
+    # statistics that are kept up to date by every change, see
+    # SQLDatabase._update_stats for the names that are used
+    sql.Table('stats', db,
+              sql.Column('name', sql.Unicode, primary_key=True),
+              sql.Column('value', sql.Integer),
+              sql.Column('datestamp', sql.DateTime))
+
+def get_schema_version(engine):
+    """Returns the schema version of an existing database, or None if
+    the database has no tables yet"""
+    inspector = Inspector.from_engine(engine)
+    if not 'records' in inspector.get_table_names():
+        return None
+    columns = [column['name'] for column in inspector.get_columns('records')]
+    if 'id' in columns:
+        # integer surrogate keys
+        return 2
+    # oai ids as primary keys
+    return 1
+
+def related_ids(metadata):
+    """Returns the oai ids of the records that a record refers to in
+    its metadata, in the fields that end with _rel"""
+    ids = set()
+    for key, values in metadata.items():
+        if key.endswith('_rel'):
+            ids.update(values)
+    return sorted(ids)
+
+def get_index_names(engine, table_name):
+    """Returns the names of the indexes of a table"""
+    inspector = Inspector.from_engine(engine)
+    return set([index['name'] for index in
+                inspector.get_indexes(table_name)])
+
+def migrate_database(uri):
+    """Migrates a database created by an older version of MOAI to the
+    current schema version, in place. Returns the version the database
+    had before the migration."""
+    engine = sql.create_engine(uri)
+    version = get_schema_version(engine)
+    if version is None:
+        return version
+    if version != SCHEMA_VERSION:
+        _migrate_tables(engine)
+    # the statistics and change numbers are added here, so server
+    # processes do not all compute them when they start
+    SQLDatabase(uri, initialize=True)
+    return version
+
+def _migrate_tables(engine):
+
+    dialect = engine.dialect
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        # move the old tables out of the way, their indexes and primary
+        # keys would clash with the new ones
+        old = sql.MetaData()
+        for name in ['setrefs', 'sets', 'records']:
+            table = sql.Table(name, old, autoload=True,
+                              autoload_with=connection)
+            for index in table.indexes:
+                index.drop(connection)
+            connection.execute('ALTER TABLE %s RENAME TO %s_v1' % (
+                name, name))
+            if dialect.name == 'postgresql':
+                connection.execute(
+                    'ALTER INDEX IF EXISTS %s_pkey RENAME TO %s_v1_pkey' % (
+                    name, name))
+
+        db = sql.MetaData()
+        define_tables(db)
+        db.create_all(bind=connection)
+
+        keys = {'records': '', 'sets': ''}
+        if dialect.name == 'oracle':
+            # oracle has no autoincrement columns
+            keys = {'records': 'records_id_seq.nextval, ',
+                    'sets': 'sets_id_seq.nextval, '}
+        connection.execute(
+            'INSERT INTO records (%s record_id, modified, deleted, metadata) '
+            'SELECT %s record_id, modified, deleted, metadata '
+            'FROM records_v1' % (keys['records'] and 'id,',
+                                 keys['records']))
+        connection.execute(
+            'INSERT INTO sets (%s set_id, hidden, name, description) '
+            'SELECT %s set_id, hidden, name, description '
+            'FROM sets_v1' % (keys['sets'] and 'id,', keys['sets']))
+        connection.execute(
+            'INSERT INTO setrefs (record_id, set_id) '
+            'SELECT r.id, s.id FROM setrefs_v1 o, records r, sets s '
+            'WHERE r.record_id = o.record_id AND s.set_id = o.set_id')
+        for name in ['setrefs', 'sets', 'records']:
+            connection.execute('DROP TABLE %s_v1' % name)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+
 class SQLDatabase(object):
     """Sql implementation of a database backend
     This implements the :ref:`IDatabase` interface, look there for
     more documentation.
     """
 
-    def __init__(self, dburi=None):
+    def __init__(self, dburi=None, config=None, initialize=False):
+        config = config or {}
         self._uri = dburi
         self._db = self._connect()
         self._records = self._db.tables['records']
         self._sets = self._db.tables['sets']
         self._setrefs = self._db.tables['setrefs']
+        self._stats = self._db.tables['stats']
+        self._changes = self._db.tables['changes']
+        self._renditions = self._db.tables['renditions']
+        self._renditionrefs = self._db.tables['renditionrefs']
+        self._upsert = (asbool(config.get('upsert', True)) and
+                        self._supports_upsert())
+        self._codec = get_codec(config.get('metadata_codec', 'json'))
+        self._codecs = {self._codec.name: self._codec}
+        self._set_index = None
+        self._set_index_generation = None
+        self._set_index_lock = threading.Lock()
+        if asbool(config.get('set_index', False)):
+            self._set_index = SetBitmapIndex()
+        self._record_cache = None
+        self._record_cache_generation = None
+        record_cache_size = int(config.get('record_cache_size', 0))
+        if record_cache_size > 0:
+            self._record_cache = LRUCache(record_cache_size)
+        if (self._get_stat(u'records') is None or
+            self._get_stat(u'sequence') is None):
+            self._initialize(initialize)
         self._reset_cache()
         
+    def _initialize(self, initialize):
+        # a new database has nothing to count, but counting the records
+        # of a database created by an older version is left to the
+        # scripts, as every server process would do it at start up
+        if not initialize and sql.select(
+            [self._records.c.id]).limit(1).execute().fetchone():
+            raise SchemaVersionError(
+                'Database %s has no statistics. '
+                'Use the migrate_moai script to add them.' % self._uri)
+        if self._get_stat(u'records') is None:
+            self.rebuild_stats()
+        if self._get_stat(u'sequence') is None:
+            self._init_changes()
+
     def _connect(self):
         dburi = self._uri
         if dburi is None:
@@ -40,91 +262,442 @@ class SQLDatabase(object):
         engine = sql.create_engine(dburi)
         db = sql.MetaData(engine)
         
-        sql.Table('records', db,
-                  sql.Column('record_id', sql.Unicode, primary_key=True),
-                  sql.Column('modified', sql.DateTime, index=True),
-                  sql.Column('deleted', sql.Boolean),
-                  sql.Column('metadata', sql.String))
-        
-        sql.Table('sets', db,
-                  sql.Column('set_id', sql.Unicode, primary_key=True),
-                  sql.Column('hidden', sql.Boolean),
-                  sql.Column('name', sql.Unicode),
-                  sql.Column('description', sql.Unicode))
-
-        sql.Table('setrefs', db,
-                  sql.Column('record_id', sql.Integer, 
-                             sql.ForeignKey('records.record_id'),
-                             index=True, primary_key=True),
-                  sql.Column('set_id', sql.Integer,
-                             sql.ForeignKey('sets.set_id'),
-                             index=True, primary_key=True))
-        
-        db.create_all()
+        self._check_schema_version(engine)
+        define_tables(db)
+        for table in db.sorted_tables:
+            try:
+                table.create(checkfirst=True)
+            except sql.exc.DBAPIError:
+                # server processes that start together race to create
+                # the tables of a new database
+                if not table.exists():
+                    raise
+        self._create_missing_indexes(engine, db)
         return db
 
-    def flush(self):
-        oai_ids = set()
-        for row in sql.select([self._records.c.record_id]).execute():
-            oai_ids.add(row[0])
-        for row in sql.select([self._sets.c.set_id]).execute():
-            oai_ids.add(row[0])
+    def _check_schema_version(self, engine):
+        version = get_schema_version(engine)
+        if version not in [None, SCHEMA_VERSION]:
+            raise SchemaVersionError(
+                'Database %s has schema version %s, version %s is needed. '
+                'Use the migrate_moai script to migrate it.' % (
+                self._uri, version, SCHEMA_VERSION))
 
-        deleted_records = []
-        deleted_sets = []
-        deleted_setrefs = []
+    def _create_missing_indexes(self, engine, db):
+        # create_all only creates indexes together with their table,
+        # databases created by an older version need them added
+        for table in db.sorted_tables:
+            existing = get_index_names(engine, table.name)
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                try:
+                    index.create(engine)
+                except sql.exc.DBAPIError:
+                    if index.name not in get_index_names(engine, table.name):
+                        raise
 
+    def _supports_upsert(self):
+        dialect = self._db.bind.dialect
+        if dialect.name == 'sqlite':
+            # ON CONFLICT ... DO UPDATE was added in sqlite 3.24
+            return dialect.dbapi.sqlite_version_info >= (3, 24, 0)
+        if dialect.name == 'postgresql':
+            return (dialect.server_version_info or (0,)) >= (9, 5)
+        return dialect.name in ['mysql', 'oracle']
+
+    def flush(self):
+        if not (self._cache['records'] or self._cache['sets']):
+            # nothing changed, so the caches of all processes stay valid
+            return
         inserted_records = []
         inserted_sets = []
-        inserted_setrefs = []
 
-        
         for oai_id, item in self._cache['records'].items():
-            if oai_id in oai_ids:
-                # record allready exists
-                deleted_records.append(oai_id)
             item['record_id'] = oai_id
             inserted_records.append(item)
 
         for oai_id, item in self._cache['sets'].items():
-            if oai_id in oai_ids:
-                # set allready exists
-                deleted_sets.append(oai_id)
             item['set_id'] = oai_id
             inserted_sets.append(item)
 
-        for record_id, set_ids in self._cache['setrefs'].items():
-            deleted_setrefs.append(record_id)
+        # the old datestamps of the records that are replaced
+        replaced = self._existing_modified(self._cache['records'])
+        self._delete_renditions(self._cache['records'])
+        existing_hidden = self._existing_hidden(self._cache['sets'])
+        existing_sets = set(existing_hidden)
+        # the sets of cached records leave out hidden sets, so they all
+        # can be wrong when a set is hidden or shown
+        hidden_changed = [set_id for set_id, hidden in existing_hidden.items()
+                          if bool(hidden) !=
+                          bool(self._cache['sets'][set_id]['hidden'])]
+
+        if self._upsert:
+            # write every record and set exactly once, using the native
+            # insert-or-update statement of the database
+            self._upsert_rows(self._sets, self._sets.c.set_id, inserted_sets)
+            self._upsert_rows(self._records, self._records.c.record_id,
+                              inserted_records)
+        else:
+            self._update_rows(self._sets, self._sets.c.set_id,
+                              inserted_sets, existing_sets)
+            self._update_rows(self._records, self._records.c.record_id,
+                              inserted_records, replaced)
+
+        self._record_changes(sorted(self._cache['records']))
+        counts = self._flush_setrefs()
+        counts[u'records'] = len(inserted_records) - len(replaced)
+        counts[u'sets'] = len(inserted_sets) - len(existing_sets)
+        self._update_stats(counts,
+                           added=[item['modified']
+                                  for item in inserted_records],
+                           removed=replaced.values(),
+                           changed=bool(inserted_sets))
+        if hidden_changed:
+            self._invalidate_record_cache()
+        else:
+            self._invalidate_record_cache(self._cache['records'])
+        self._reset_cache()
+        self._invalidate_set_index()
+
+    def _flush_setrefs(self):
+        # only the setrefs that changed are deleted or inserted, returns
+        # the changes of the per set record counts
+        setrefs = self._cache['setrefs']
+        record_keys = self._get_keys(self._records.c.record_id, setrefs)
+        set_keys = self._get_keys(
+            self._sets.c.set_id,
+            set([set_id for set_ids in setrefs.values()
+                 for set_id in set_ids]))
+
+        existing = set()
+        for chunk in chunked(record_keys.values()):
+            for row in sql.select([self._setrefs.c.record_id,
+                                   self._setrefs.c.set_id],
+                                  self._setrefs.c.record_id.in_(chunk)
+                                  ).execute():
+                existing.add((row[0], row[1]))
+
+        flushed = set()
+        for record_id, set_ids in setrefs.items():
             for set_id in set_ids:
-                inserted_setrefs.append(
-                    {'record_id':record_id, 'set_id': set_id})
-
-        # delete all processed records before inserting
-        if deleted_records:
-            self._records.delete(
-                self._records.c.record_id == sql.bindparam('record_id')
-                ).execute(
-                [{'record_id': rid} for rid in deleted_records])
-        if deleted_sets:
-            self._sets.delete(
-                self._sets.c.set_id == sql.bindparam('set_id')
-                ).execute(
-                [{'set_id': sid} for sid in deleted_sets])
+                flushed.add((record_keys[record_id], set_keys[set_id]))
+
+        deleted_setrefs = [{'record_key': record_key, 'set_key': set_key}
+                           for record_key, set_key in existing - flushed]
+        inserted_setrefs = [{'record_id': record_key, 'set_id': set_key}
+                            for record_key, set_key in flushed - existing]
+
         if deleted_setrefs:
             self._setrefs.delete(
-                self._setrefs.c.record_id == sql.bindparam('record_id')
-                ).execute(
-                [{'record_id': rid} for rid in deleted_setrefs])
-
-        # batch inserts
-        if inserted_records:
-            self._records.insert().execute(inserted_records)
-        if inserted_sets:
-            self._sets.insert().execute(inserted_sets)
+                sql.and_(
+                self._setrefs.c.record_id == sql.bindparam('record_key'),
+                self._setrefs.c.set_id == sql.bindparam('set_key'))
+                ).execute(deleted_setrefs)
         if inserted_setrefs:
             self._setrefs.insert().execute(inserted_setrefs)
 
-        self._reset_cache()
+        counts = {}
+        for record_key, set_key in existing - flushed:
+            name = u'set:%s' % set_key
+            counts[name] = counts.get(name, 0) - 1
+        for record_key, set_key in flushed - existing:
+            name = u'set:%s' % set_key
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def _get_keys(self, column, oai_ids):
+        # returns a dictionary mapping oai ids to surrogate keys
+        keys = {}
+        for chunk in chunked(oai_ids):
+            for row in sql.select([column, column.table.c.id],
+                                  column.in_(chunk)).execute():
+                keys[row[0]] = row[1]
+        return keys
+
+    def _upsert_rows(self, table, key, rows):
+        if not rows:
+            return
+        dialect = self._db.bind.dialect
+        preparer = dialect.identifier_preparer
+        table_name = preparer.format_table(table)
+        # surrogate keys are generated by the database
+        surrogate_key = table.c.get('id')
+        data_columns = [c for c in table.c if not c is surrogate_key]
+        key = preparer.format_column(key)
+        columns = [preparer.format_column(c) for c in data_columns]
+        values = [':%s' % c.name for c in data_columns]
+        updates = [c for c in columns if c != key]
+
+        if dialect.name in ['sqlite', 'postgresql']:
+            statement = (
+                'INSERT INTO %s (%s) VALUES (%s) '
+                'ON CONFLICT (%s) DO UPDATE SET %s' % (
+                table_name, ', '.join(columns), ', '.join(values), key,
+                ', '.join(['%s = excluded.%s' % (c, c) for c in updates])))
+        elif dialect.name == 'mysql':
+            statement = (
+                'INSERT INTO %s (%s) VALUES (%s) '
+                'ON DUPLICATE KEY UPDATE %s' % (
+                table_name, ', '.join(columns), ', '.join(values),
+                ', '.join(['%s = VALUES(%s)' % (c, c) for c in updates])))
+        elif dialect.name == 'oracle':
+            inserted_columns = columns
+            inserted_values = ['s.%s' % c for c in columns]
+            if surrogate_key is not None:
+                inserted_columns = ([preparer.format_column(surrogate_key)] +
+                                    inserted_columns)
+                inserted_values = (['%s.nextval' % preparer.format_sequence(
+                    surrogate_key.default)] + inserted_values)
+            statement = (
+                'MERGE INTO %s t USING (SELECT %s FROM dual) s ON (%s) '
+                'WHEN MATCHED THEN UPDATE SET %s '
+                'WHEN NOT MATCHED THEN INSERT (%s) VALUES (%s)' % (
+                table_name,
+                ', '.join(['%s AS %s' % (v, c)
+                           for v, c in zip(values, columns)]),
+                't.%s = s.%s' % (key, key),
+                ', '.join(['t.%s = s.%s' % (c, c) for c in updates]),
+                ', '.join(inserted_columns),
+                ', '.join(inserted_values)))
+        else:
+            raise ValueError('No upsert support for database: %s' % (
+                dialect.name))
+
+        # typed bindparams, so the column types still convert the values
+        statement = sql.text(statement, bindparams=[
+            sql.bindparam(c.name, type_=c.type) for c in data_columns])
+        self._db.bind.execute(statement, rows)
+
+    def _update_rows(self, table, key, rows, existing):
+        # fallback for databases without upsert support, existing rows
+        # are updated in place so their surrogate keys stay the same
+        updated_rows = []
+        inserted_rows = []
+        for row in rows:
+            if row[key.name] in existing:
+                row = row.copy()
+                row['oai_id'] = row[key.name]
+                updated_rows.append(row)
+            else:
+                inserted_rows.append(row)
+        if updated_rows:
+            table.update(key == sql.bindparam('oai_id')).execute(updated_rows)
+        if inserted_rows:
+            table.insert().execute(inserted_rows)
+
+    def _existing_ids(self, column, oai_ids):
+        # only look up the ids that are about to be flushed, so the cost
+        # of a flush does not depend on the size of the tables
+        existing = set()
+        for chunk in chunked(oai_ids):
+            for row in sql.select([column], column.in_(chunk)).execute():
+                existing.add(row[0])
+        return existing
+
+    def _existing_hidden(self, set_ids):
+        # returns a dictionary with the hidden flags of the existing sets
+        hidden = {}
+        for chunk in chunked(set_ids):
+            for row in sql.select([self._sets.c.set_id, self._sets.c.hidden],
+                                  self._sets.c.set_id.in_(chunk)
+                                  ).execute():
+                hidden[row[0]] = row[1]
+        return hidden
+
+    def _existing_modified(self, oai_ids):
+        # returns a dictionary with the datestamps of the existing records
+        modified = {}
+        for chunk in chunked(oai_ids):
+            for row in sql.select([self._records.c.record_id,
+                                   self._records.c.modified],
+                                  self._records.c.record_id.in_(chunk)
+                                  ).execute():
+                modified[row[0]] = row[1]
+        return modified
+
+    def _next_sequence(self, count):
+        # reserves count change numbers and returns the first one, the
+        # counter is read in the same transaction that increments it
+        connection = self._db.bind.connect()
+        transaction = connection.begin()
+        try:
+            name = self._stats.c.name == u'sequence'
+            connection.execute(self._stats.update(
+                name, values={'value': self._stats.c.value + count}))
+            last = connection.execute(
+                sql.select([self._stats.c.value], name)).fetchone()[0]
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+        return last - count + 1
+
+    def _record_changes(self, oai_ids, removed=False):
+        # gives the records a new change number
+        if not oai_ids:
+            return
+        first = self._next_sequence(len(oai_ids))
+        rows = [{'record_id': oai_id, 'seq': first + i, 'removed': removed}
+                for i, oai_id in enumerate(oai_ids)]
+        if self._upsert:
+            self._upsert_rows(self._changes, self._changes.c.record_id, rows)
+        else:
+            self._update_rows(self._changes, self._changes.c.record_id, rows,
+                              self._existing_ids(self._changes.c.record_id,
+                                                 oai_ids))
+
+    def _init_changes(self, batch_size=1000):
+        # numbers the existing records of a database that was created
+        # by an older version, in (modified, record_id) order
+        self._changes.delete().execute()
+        self._set_stat(u'sequence', 0)
+        after = None
+        while True:
+            query = sql.select([self._records.c.modified,
+                                self._records.c.record_id],
+                               order_by=[self._records.c.modified,
+                                         self._records.c.record_id])
+            if not after is None:
+                query.append_whereclause(
+                    sql.or_(self._records.c.modified > after[0],
+                            sql.and_(self._records.c.modified == after[0],
+                                     self._records.c.record_id > after[1])))
+            rows = query.limit(batch_size).execute().fetchall()
+            if not rows:
+                return
+            after = tuple(rows[-1])
+            self._record_changes([row.record_id for row in rows])
+
+    def last_sequence(self):
+        """Returns the change number of the latest change"""
+        return self._get_stat(u'sequence').value
+
+    def get_changes(self, after=0, batch_size=100, fields=None):
+        """Returns the records that changed after the change number
+        after, in the order in which they changed. Every change has a
+        'seq' and an 'id', removed records only have a 'removed' flag,
+        the others have the requested record fields."""
+        fields = set(fields or RECORD_FIELDS)
+        query = sql.select(
+            [self._changes.c.seq,
+             self._changes.c.record_id,
+             self._changes.c.removed] + self._record_columns(fields),
+            self._changes.c.seq > after,
+            from_obj=[self._changes.outerjoin(
+                self._records,
+                self._changes.c.record_id == self._records.c.record_id)],
+            order_by=[self._changes.c.seq],
+            use_labels=True)
+        changes = []
+        rows = query.limit(batch_size).execute().fetchall()
+        if 'sets' in fields:
+            setrefs = self._get_setrefs_batch(
+                [row.records_record_id for row in rows
+                 if not row.changes_removed])
+        for row in rows:
+            change = {'seq': row.changes_seq}
+            if row.changes_removed:
+                change['id'] = row.changes_record_id
+                change['removed'] = True
+                changes.append(change)
+                continue
+            change.update({'id': row.records_record_id,
+                           'removed': False,
+                           'deleted': row.records_deleted,
+                           'modified': row.records_modified})
+            if 'metadata' in fields:
+                change['metadata'] = self._decode_metadata(
+                    row.records_metadata)
+            if 'sets' in fields:
+                change['sets'] = setrefs[row.records_record_id]
+            changes.append(change)
+        return changes
+
+    def _get_stat(self, name):
+        return self._stats.select(
+            self._stats.c.name == name).execute().fetchone()
+
+    def _set_stat(self, name, value=None, datestamp=None):
+        values = {'value': value, 'datestamp': datestamp}
+        self._update_stat(name, values, values)
+
+    def _add_stat(self, name, delta):
+        # counters are changed in the database, so changes made by
+        # other processes are never overwritten
+        self._update_stat(name, {'value': self._stats.c.value + delta},
+                          {'value': delta})
+
+    def _update_stat(self, name, values, initial):
+        update = self._stats.update(self._stats.c.name == name,
+                                    values=values)
+        if update.execute().rowcount:
+            return
+        try:
+            self._stats.insert().execute(name=name, **initial)
+        except sql.exc.IntegrityError:
+            # another process added the stat after the update
+            update.execute()
+
+    def _update_stats(self, counts, added=(), removed=(), changed=False):
+        # counts has the changes of the counters, added and removed the
+        # datestamps of the records that were written and replaced or
+        # deleted. Both datestamps are exact. changed tells that rows
+        # were written that are not counted, like existing sets.
+        changed = changed or bool(added) or bool(removed)
+        for name, delta in counts.items():
+            if delta:
+                self._add_stat(name, delta)
+                changed = True
+        if not changed:
+            return
+        earliest = self._get_stat(u'earliest').datestamp
+        latest = self._get_stat(u'latest').datestamp
+        if removed and earliest is not None and min(removed) <= earliest:
+            # the earliest record was changed, the index on modified
+            # makes finding the new one cheap
+            earliest = sql.select([sql.func.min(self._records.c.modified)]
+                                  ).execute().fetchone()[0]
+        elif added:
+            earliest = min([d for d in [earliest] if d is not None] + added)
+        if removed and latest is not None and max(removed) >= latest:
+            # a record in the future keeps responses from being cached,
+            # so the latest datestamp is exact as well
+            latest = sql.select([sql.func.max(self._records.c.modified)]
+                                ).execute().fetchone()[0]
+        elif added:
+            latest = max([d for d in [latest] if d is not None] + added)
+        self._set_stat(u'earliest', datestamp=earliest)
+        self._set_stat(u'latest', datestamp=latest)
+        # every change gets a new generation, so other processes
+        # can tell that their cached data is outdated
+        self._add_stat(u'generation', 1)
+
+    def rebuild_stats(self):
+        """Recalculates the statistics of the database from the
+        records and sets tables"""
+        self._stats.delete(sql.not_(self._stats.c.name.in_(
+            [u'generation', u'sequence']))).execute()
+        self._set_stat(u'records', self._count(self._records))
+        self._set_stat(u'sets', self._count(self._sets))
+        row = sql.select([sql.func.min(self._records.c.modified),
+                          sql.func.max(self._records.c.modified)]
+                         ).execute().fetchone()
+        self._set_stat(u'earliest', datestamp=row[0])
+        self._set_stat(u'latest', datestamp=row[1])
+        counts = sql.select([self._setrefs.c.set_id, sql.func.count('*')],
+                            group_by=[self._setrefs.c.set_id]).execute()
+        rows = [{'name': u'set:%s' % set_key, 'value': count}
+                for set_key, count in counts]
+        if rows:
+            self._stats.insert().execute(rows)
+        self._add_stat(u'generation', 1)
+
+    def _count(self, table):
+        return sql.select([sql.func.count('*')],
+                          from_obj=[table]).execute().fetchone()[0]
 
     def _reset_cache(self):
         self._cache = {'records': {}, 'sets': {}, 'setrefs': {}}
@@ -156,13 +729,7 @@ class SQLDatabase(object):
                    prefix="record %s" % oai_id,
                    suffix='for parameter "metadata"')
 
-        def date_handler(obj):
-            if hasattr(obj, 'isoformat'):
-                return obj.isoformat()
-            else:
-                raise TypeError, 'Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj))
-
-        metadata = json.dumps(metadata, default=date_handler)
+        metadata = self._codec.encode(metadata)
         self._cache['records'][oai_id] = (dict(modified=modified,
                                                deleted=deleted,
                                                metadata=metadata))
@@ -174,16 +741,82 @@ class SQLDatabase(object):
                 hidden = sets[set_id].get('hidden', False))
             self._cache['setrefs'][oai_id].append(set_id)
             
+    def _decode_metadata(self, value):
+        # every value is decoded with the codec it was stored with
+        tag = get_tag(value)
+        codec = self._codecs.get(tag)
+        if codec is None:
+            codec = self._codecs[tag] = get_codec(tag)
+        return codec.decode(value)
+
+    def recode_metadata(self, batch_size=1000):
+        """Re-encodes the metadata of all records that were stored with
+        another codec than the configured one, in place. Returns the
+        number of updated records."""
+        count = 0
+        last_id = None
+        while True:
+            query = sql.select([self._records.c.record_id,
+                                self._records.c.metadata],
+                               order_by=[self._records.c.record_id])
+            if not last_id is None:
+                query.append_whereclause(self._records.c.record_id > last_id)
+            rows = query.limit(batch_size).execute().fetchall()
+            if not rows:
+                return count
+            last_id = rows[-1].record_id
+            updated = [{'oai_id': row.record_id,
+                        'metadata': self._codec.encode(
+                            self._decode_metadata(row.metadata))}
+                       for row in rows
+                       if get_tag(row.metadata) != self._codec.name]
+            if updated:
+                self._records.update(
+                    self._records.c.record_id == sql.bindparam('oai_id'),
+                    values={'metadata': sql.bindparam('metadata')}
+                    ).execute(updated)
+                count += len(updated)
+
     def get_record(self, oai_id):
-        row = self._records.select(
-            self._records.c.record_id == oai_id).execute().fetchone()
-        if row is None:
-            return
+        return self.get_records([oai_id])[0]
+
+    def get_records(self, oai_ids):
+        """Returns the records with the given ids in the same order,
+        with None for the ids that do not exist. The rows and sets are
+        read with one query per chunk of ids."""
+        cache = self._get_record_cache()
+        found = {}
+        if cache is not None:
+            for oai_id in set(oai_ids):
+                record = cache.get(oai_id)
+                if record is not None:
+                    found[oai_id] = record
+        rows = {}
+        for chunk in chunked(set(oai_ids) - set(found)):
+            for row in self._records.select(
+                self._records.c.record_id.in_(chunk)).execute():
+                rows[row.record_id] = row
+        setrefs = self._get_setrefs_batch(rows.keys())
+        for oai_id, row in rows.items():
+            found[oai_id] = self._cache_record(row, setrefs[oai_id], cache)
+        records = []
+        for oai_id in oai_ids:
+            record = found.get(oai_id)
+            if record is not None:
+                # cached records are shared, callers get their own copy
+                record = dict(record, sets=list(record['sets']))
+            records.append(record)
+        return records
+
+    def _cache_record(self, row, sets, cache):
+        # decodes a full records row, and keeps it in the cache
         record = {'id': row.record_id,
                   'deleted': row.deleted,
                   'modified': row.modified,
-                  'metadata': json.loads(row.metadata),
-                  'sets': self.get_setrefs(oai_id)}
+                  'metadata': self._decode_metadata(row.metadata),
+                  'sets': sets}
+        if cache is not None:
+            cache.put(row.record_id, record)
         return record
 
     def get_set(self, oai_id):
@@ -197,38 +830,237 @@ class SQLDatabase(object):
                 'hidden': row.hidden}
 
     def get_setrefs(self, oai_id, include_hidden_sets=False):
-        set_ids = []
-        query = sql.select([self._setrefs.c.set_id])
-        query.append_whereclause(self._setrefs.c.record_id == oai_id)
-        if include_hidden_sets == False:
-            query.append_whereclause(
-                sql.and_(self._sets.c.set_id == self._setrefs.c.set_id,
-                         self._sets.c.hidden == include_hidden_sets))
-        
-        for row in query.execute():
-            set_ids.append(row[0])
-        set_ids.sort()
-        return set_ids
+        return self._get_setrefs_batch(
+            [oai_id], include_hidden_sets)[oai_id]
+
+    def _get_setrefs_batch(self, oai_ids, include_hidden_sets=False):
+        # returns a dictionary with the sorted set ids of every record,
+        # using one query per chunk of records instead of one per record
+        setrefs = dict([(oai_id, []) for oai_id in oai_ids])
+        for chunk in chunked(setrefs):
+            query = sql.select(
+                [self._records.c.record_id, self._sets.c.set_id],
+                sql.and_(self._records.c.record_id.in_(chunk),
+                         self._setrefs.c.record_id == self._records.c.id,
+                         self._setrefs.c.set_id == self._sets.c.id))
+            if include_hidden_sets == False:
+                query.append_whereclause(self._sets.c.hidden == False)
+            for row in query.execute():
+                setrefs[row[0]].append(row[1])
+        for set_ids in setrefs.values():
+            set_ids.sort()
+        return setrefs
 
     def record_count(self):
-        return sql.select([sql.func.count('*')],
-                          from_obj=[self._records]).execute().fetchone()[0]
+        return self._get_stat(u'records').value
 
     def set_count(self):
-        return sql.select([sql.func.count('*')],
-                          from_obj=[self._sets]).execute().fetchone()[0]
-        
+        return self._get_stat(u'sets').value
+
+    def generation(self):
+        """Returns a number that changes whenever the records or sets
+        in the database change"""
+        return self._get_stat(u'generation').value
+
+    def latest_datestamp(self):
+        """Returns a datestamp that no record is modified after, or
+        None if there are no records"""
+        return self._get_stat(u'latest').datestamp
+
     def remove_record(self, oai_id):
-        self._records.delete(
-            self._records.c.record_id == oai_id).execute()
+        row = sql.select([self._records.c.id, self._records.c.modified],
+                         self._records.c.record_id == oai_id
+                         ).execute().fetchone()
+        if row is None:
+            return
+        record_key, modified = row
+        counts = {u'records': -1}
+        for set_row in sql.select([self._setrefs.c.set_id],
+                                  self._setrefs.c.record_id == record_key
+                                  ).execute():
+            counts[u'set:%s' % set_row[0]] = -1
         self._setrefs.delete(
-            self._setrefs.c.record_id == oai_id).execute()
+            self._setrefs.c.record_id == record_key).execute()
+        self._delete_renditions([oai_id])
+        self._renditionrefs.delete(
+            self._renditionrefs.c.record_id == record_key).execute()
+        self._records.delete(
+            self._records.c.id == record_key).execute()
+        self._record_changes([oai_id], removed=True)
+        self._update_stats(counts, removed=[modified])
+        self._invalidate_record_cache([oai_id])
+        self._invalidate_set_index()
 
     def remove_set(self, oai_id):
-        self._sets.delete(
-            self._sets.c.set_id == oai_id).execute()
+        row = sql.select([self._sets.c.id],
+                         self._sets.c.set_id == oai_id).execute().fetchone()
+        if row is None:
+            return
+        set_key = row[0]
+        # the records lose a set, which changes their headers
+        self._record_changes(sorted([
+            row[0] for row in sql.select(
+            [self._records.c.record_id],
+            sql.and_(self._setrefs.c.set_id == set_key,
+                     self._setrefs.c.record_id == self._records.c.id)
+            ).execute()]))
+        self._renditions.delete(self._renditions.c.record_id.in_(
+            sql.select([self._setrefs.c.record_id],
+                       self._setrefs.c.set_id == set_key))).execute()
         self._setrefs.delete(
-            self._setrefs.c.set_id == oai_id).execute()
+            self._setrefs.c.set_id == set_key).execute()
+        self._sets.delete(
+            self._sets.c.id == set_key).execute()
+        self._stats.delete(
+            self._stats.c.name == u'set:%s' % set_key).execute()
+        self._update_stats({u'sets': -1})
+        self._invalidate_record_cache()
+        self._invalidate_set_index()
+
+    def _delete_renditions(self, oai_ids):
+        # renditions of changed records are outdated, and so are the
+        # renditions of the records that show them
+        for chunk in chunked(oai_ids):
+            self._renditions.delete(self._renditions.c.record_id.in_(
+                sql.select([self._records.c.id],
+                           self._records.c.record_id.in_(chunk)))).execute()
+            self._renditions.delete(self._renditions.c.record_id.in_(
+                sql.select([self._renditionrefs.c.record_id],
+                           self._renditionrefs.c.related_id.in_(chunk)))
+                ).execute()
+
+    def render_metadata(self, prefix, render, batch_size=500):
+        """Stores render(record) as the rendition of every record that
+        is not deleted and has no rendition for the metadata prefix yet.
+        Records for which render returns None are skipped. Returns the
+        number of stored renditions."""
+        prefix = unicode(prefix)
+        count = 0
+        last_key = None
+        while True:
+            query = sql.select(
+                [self._records.c.id,
+                 self._records.c.record_id,
+                 self._records.c.modified,
+                 self._records.c.deleted,
+                 self._records.c.metadata],
+                sql.and_(self._renditions.c.record_id == None,
+                         self._records.c.deleted == False),
+                from_obj=[self._record_from(prefix)],
+                order_by=[self._records.c.id])
+            if not last_key is None:
+                query.append_whereclause(self._records.c.id > last_key)
+            rows = query.limit(batch_size).execute().fetchall()
+            if not rows:
+                return count
+            last_key = rows[-1].id
+            setrefs = self._get_setrefs_batch(
+                [row.record_id for row in rows])
+            renditions = []
+            refs = []
+            for row in rows:
+                metadata = self._decode_metadata(row.metadata)
+                xml = render({'id': row.record_id,
+                              'deleted': row.deleted,
+                              'modified': row.modified,
+                              'metadata': metadata,
+                              'sets': setrefs[row.record_id]})
+                if xml is not None:
+                    renditions.append({'record_id': row.id,
+                                       'prefix': prefix,
+                                       'xml': xml})
+                    refs.extend([{'record_id': row.id, 'related_id': id}
+                                 for id in related_ids(metadata)])
+            if renditions:
+                self._renditionrefs.delete(
+                    self._renditionrefs.c.record_id.in_(
+                    [r['record_id'] for r in renditions])).execute()
+                self._renditions.insert().execute(renditions)
+                count += len(renditions)
+            if refs:
+                self._renditionrefs.insert().execute(refs)
+
+    def clear_renditions(self, prefix=None):
+        """Removes the renditions of a metadata prefix, or all of them"""
+        query = self._renditions.delete()
+        if not prefix is None:
+            query = self._renditions.delete(
+                self._renditions.c.prefix == unicode(prefix))
+        else:
+            self._renditionrefs.delete().execute()
+        query.execute()
+
+    def _get_record_cache(self):
+        cache = self._record_cache
+        if cache is None:
+            return cache
+        # drop everything when another process changed the database
+        generation = self.generation()
+        if generation != self._record_cache_generation:
+            cache.clear()
+            self._record_cache_generation = generation
+        return cache
+
+    def _invalidate_record_cache(self, oai_ids=None):
+        # drops the changed records, or all records if oai_ids is None
+        cache = self._record_cache
+        if cache is None:
+            return
+        if oai_ids is None:
+            cache.clear()
+        else:
+            for oai_id in oai_ids:
+                cache.discard(oai_id)
+        # the change increased the generation by one, if it increased
+        # more another process made changes too and the next
+        # _get_record_cache call clears the cache
+        if self._record_cache_generation is not None:
+            generation = self.generation()
+            if generation == self._record_cache_generation + 1:
+                self._record_cache_generation = generation
+
+    def record_cache_info(self):
+        """Returns the hits, misses, size and maxsize of the record
+        cache, or None if the cache is disabled"""
+        if self._record_cache is None:
+            return None
+        return self._record_cache.info()
+
+    def _invalidate_set_index(self):
+        # the index is rebuilt when it is needed again, so a series
+        # of flushes does not rebuild it every time
+        if self._set_index is not None:
+            self._set_index.invalidate()
+
+    def _get_set_index(self):
+        index = self._set_index
+        if index is None:
+            return index
+        # the generation also changes when another process (like the
+        # update_moai script) changes the database
+        generation = self.generation()
+        if index.valid and generation == self._set_index_generation:
+            return index
+        # one thread builds a new index, the others wait for it, and
+        # requests that still use the old index are not affected
+        with self._set_index_lock:
+            index = self._set_index
+            generation = self.generation()
+            if index.valid and generation == self._set_index_generation:
+                return index
+            records = sql.select([self._records.c.modified,
+                                  self._records.c.record_id])
+            setrefs = sql.select([self._records.c.record_id,
+                                  self._sets.c.set_id],
+                                 sql.and_(
+                self._setrefs.c.record_id == self._records.c.id,
+                self._setrefs.c.set_id == self._sets.c.id))
+            index = SetBitmapIndex()
+            index.build(records.execute().fetchall(),
+                        setrefs.execute().fetchall())
+            self._set_index = index
+            self._set_index_generation = generation
+        return index
 
     def oai_sets(self, offset=0, batch_size=20):
         for row in self._sets.select(
@@ -239,87 +1071,275 @@ class SQLDatabase(object):
                    'description': row.description}
 
     def oai_earliest_datestamp(self):
-        row = sql.select([self._records.c.modified],
-                         order_by=[sql.asc(self._records.c.modified)]
-                         ).limit(1).execute().fetchone()
-        if row:
-            return row[0]
+        earliest = self._get_stat(u'earliest').datestamp
+        if earliest is not None:
+            return earliest
         return datetime.datetime(1970, 1, 1)
     
-    def oai_query(self,
-                  offset=0,
-                  batch_size=20,
-                  needed_sets=None,
-                  disallowed_sets=None,
-                  allowed_sets=None,
-                  from_date=None,
-                  until_date=None,
-                  identifier=None):
+    def _record_columns(self, fields, rendition=None):
+        # only the requested fields are read, so header only queries
+        # never touch the metadata column
+        columns = [self._records.c.record_id,
+                   self._records.c.modified,
+                   self._records.c.deleted]
+        if 'metadata' in fields:
+            columns.append(self._records.c.metadata)
+            if not rendition is None:
+                columns.append(self._renditions.c.xml.label('rendition'))
+        return columns
+
+    def _record_from(self, rendition=None):
+        # the records table, joined with the renditions of a prefix
+        if rendition is None:
+            return self._records
+        return self._records.outerjoin(
+            self._renditions,
+            sql.and_(self._renditions.c.record_id == self._records.c.id,
+                     self._renditions.c.prefix == unicode(rendition)))
+
+    def _setrefs_select(self, set_ids):
+        # the surrogate keys of all records in one of the sets
+        return sql.select(
+            [self._setrefs.c.record_id],
+            self._setrefs.c.set_id.in_(
+                sql.select([self._sets.c.id],
+                           self._sets.c.set_id.in_(list(set_ids)))))
+
+    def _oai_select(self,
+                    needed_sets=None,
+                    disallowed_sets=None,
+                    allowed_sets=None,
+                    from_date=None,
+                    until_date=None,
+                    identifier=None,
+                    after=None,
+                    fields=RECORD_FIELDS,
+                    order='desc',
+                    rendition=None):
+        # builds the (unbatched) select statement used by oai_query
 
         needed_sets = needed_sets or []
         disallowed_sets = disallowed_sets or []
         allowed_sets = allowed_sets or []
-        if batch_size < 0:
-            batch_size = 0
 
-        # make sure until date is set, and not in future
-        if until_date == None or until_date > datetime.datetime.utcnow():
-            until_date = datetime.datetime.utcnow()
+        until_date = self._until_date(until_date)
+        columns = self._record_columns(fields, rendition)
 
+        # the record_id is used as a tie breaker, so every record has
+        # a unique position that can be resumed from
+        direction = {'asc': sql.asc, 'desc': sql.desc}[order]
+        query = sql.select(
+            columns,
+            from_obj=[self._record_from(rendition)],
+            order_by=[direction(self._records.c.modified),
+                      direction(self._records.c.record_id)])
 
-        query = self._records.select(
-            order_by=[sql.desc(self._records.c.modified)])
+        if not after is None:
+            # keyset pagination, continue after the (modified, record_id)
+            # of the last record of the previous page. The OR can not be
+            # used as an index range, so the date of the last record is
+            # also merged into the date range, which makes the database
+            # seek to it instead of scanning the skipped records
+            after_modified, after_id = after
+            if order == 'asc':
+                query.append_whereclause(
+                    sql.or_(self._records.c.modified > after_modified,
+                            sql.and_(
+                        self._records.c.modified == after_modified,
+                        self._records.c.record_id > after_id)))
+                if from_date is None or from_date < after_modified:
+                    from_date = after_modified
+            else:
+                query.append_whereclause(
+                    sql.or_(self._records.c.modified < after_modified,
+                            sql.and_(
+                        self._records.c.modified == after_modified,
+                        self._records.c.record_id < after_id)))
+                until_date = min(until_date, after_modified)
 
         # filter dates
         query.append_whereclause(self._records.c.modified <= until_date)
+        if not from_date is None:
+            query.append_whereclause(self._records.c.modified >= from_date)
 
         if not identifier is None:
             query.append_whereclause(self._records.c.record_id == identifier)
 
-        if not from_date is None:
-            query.append_whereclause(self._records.c.modified >= from_date)
+        # filter sets, every filter is a semi-join on the setrefs
+        # table, so records are never duplicated and no DISTINCT is needed
+        for set_id in needed_sets:
+            query.append_whereclause(
+                self._records.c.id.in_(self._setrefs_select([set_id])))
 
-        # filter sets
+        if allowed_sets:
+            query.append_whereclause(
+                self._records.c.id.in_(self._setrefs_select(allowed_sets)))
 
-        setclauses = []
-        for set_id in needed_sets:
-            alias = self._setrefs.alias()
-            setclauses.append(
-                sql.and_(
-                alias.c.set_id == set_id,
-                alias.c.record_id == self._records.c.record_id))
-            
-        if setclauses:
-            query.append_whereclause((sql.and_(*setclauses)))
-            
-        allowed_setclauses = []
-        for set_id in allowed_sets:
-            alias = self._setrefs.alias()
-            allowed_setclauses.append(
-                sql.and_(
-                alias.c.set_id == set_id,
-                alias.c.record_id == self._records.c.record_id))
-            
-        if allowed_setclauses:
-            query.append_whereclause(sql.or_(*allowed_setclauses))
-
-        disallowed_setclauses = []
-        for set_id in disallowed_sets:
-            alias = self._setrefs.alias()
-            disallowed_setclauses.append(
-                sql.exists([self._records.c.record_id],
-                           sql.and_(
-                alias.c.set_id == set_id,
-                alias.c.record_id == self._records.c.record_id)))
-            
-        if disallowed_setclauses:
-            query.append_whereclause(sql.not_(sql.or_(*disallowed_setclauses)))
-            
-        for row in query.distinct().offset(offset).limit(batch_size).execute():
-            yield {'id': row.record_id,
-                   'deleted': row.deleted,
-                   'modified': row.modified,
-                   'metadata': json.loads(row.metadata),
-                   'sets': self.get_setrefs(row.record_id)
-                   }
+        if disallowed_sets:
+            query.append_whereclause(
+                sql.not_(self._records.c.id.in_(
+                    self._setrefs_select(disallowed_sets))))
+        return query
+
+    def oai_query(self,
+                  offset=0,
+                  batch_size=20,
+                  needed_sets=None,
+                  disallowed_sets=None,
+                  allowed_sets=None,
+                  from_date=None,
+                  until_date=None,
+                  identifier=None,
+                  after=None,
+                  fields=None,
+                  order='desc',
+                  rendition=None):
+
+        if batch_size < 0:
+            batch_size = 0
+        fields = set(fields or RECORD_FIELDS)
+        if order not in ['asc', 'desc']:
+            raise ValueError('Unknown sort order: %s' % order)
+
+        index = self._get_set_index()
+        if index is not None and identifier is None:
+            rows = self._oai_index_rows(index,
+                                        offset,
+                                        batch_size,
+                                        needed_sets=needed_sets,
+                                        disallowed_sets=disallowed_sets,
+                                        allowed_sets=allowed_sets,
+                                        from_date=from_date,
+                                        until_date=until_date,
+                                        after=after,
+                                        fields=fields,
+                                        order=order,
+                                        rendition=rendition)
+        else:
+            query = self._oai_select(needed_sets=needed_sets,
+                                     disallowed_sets=disallowed_sets,
+                                     allowed_sets=allowed_sets,
+                                     from_date=from_date,
+                                     until_date=until_date,
+                                     identifier=identifier,
+                                     after=after,
+                                     fields=fields,
+                                     order=order,
+                                     rendition=rendition)
+            rows = query.offset(offset).limit(batch_size).execute(
+                ).fetchall()
+
+        cache = self._get_record_cache()
+        cached = {}
+        if cache is not None:
+            for row in rows:
+                record = cache.get(row.record_id)
+                if record is not None:
+                    cached[row.record_id] = record
+        if 'sets' in fields:
+            # fetch the sets of the whole page at once
+            setrefs = self._get_setrefs_batch(
+                [row.record_id for row in rows
+                 if row.record_id not in cached])
+        for row in rows:
+            xml = None
+            if not rendition is None and 'metadata' in fields:
+                xml = row.rendition
+            full = cached.get(row.record_id)
+            if (full is None and xml is None and
+                fields.issuperset(RECORD_FIELDS)):
+                full = self._cache_record(row, setrefs[row.record_id], cache)
+            record = {'id': row.record_id,
+                      'deleted': row.deleted,
+                      'modified': row.modified}
+            if xml is not None:
+                # the stored rendition replaces the metadata
+                record['rendition'] = xml
+            elif 'metadata' in fields:
+                if full is not None:
+                    record['metadata'] = full['metadata']
+                else:
+                    record['metadata'] = self._decode_metadata(row.metadata)
+            if 'sets' in fields:
+                if full is not None:
+                    record['sets'] = list(full['sets'])
+                else:
+                    record['sets'] = setrefs[row.record_id]
+            yield record
 
+    def _oai_index_rows(self, index, offset, batch_size, **kw):
+        # the bitmap index gives the ids of the page, only those
+        # records are read from the database
+        fields = kw.pop('fields')
+        rendition = kw.pop('rendition')
+        order = kw['order']
+        kw['until_date'] = self._until_date(kw['until_date'])
+        ids = index.select(index.candidates(**kw), offset, batch_size, order)
+        rows = {}
+        for chunk in chunked(ids):
+            for row in sql.select(self._record_columns(fields, rendition),
+                                  self._records.c.record_id.in_(chunk),
+                                  from_obj=[self._record_from(rendition)]
+                                  ).execute():
+                rows[row.record_id] = row
+        return [rows[id] for id in ids if id in rows]
+
+    def _until_date(self, until_date):
+        # make sure until date is set, and not in future
+        now = datetime.datetime.utcnow()
+        if until_date == None or until_date > now:
+            return now
+        return until_date
+
+    def oai_count(self,
+                  needed_sets=None,
+                  disallowed_sets=None,
+                  allowed_sets=None,
+                  from_date=None,
+                  until_date=None):
+        """Returns the number of records an oai_query with the same
+        filters would return in total"""
+        count = self._stats_count(needed_sets, disallowed_sets,
+                                  allowed_sets, from_date, until_date)
+        if count is not None:
+            return count
+        index = self._get_set_index()
+        if index is not None:
+            return index.count(index.candidates(
+                needed_sets=needed_sets,
+                disallowed_sets=disallowed_sets,
+                allowed_sets=allowed_sets,
+                from_date=from_date,
+                until_date=self._until_date(until_date)))
+        query = self._oai_select(needed_sets=needed_sets,
+                                 disallowed_sets=disallowed_sets,
+                                 allowed_sets=allowed_sets,
+                                 from_date=from_date,
+                                 until_date=until_date,
+                                 fields=HEADER_FIELDS)
+        query = sql.select([sql.func.count('*')],
+                           from_obj=[query.order_by(None).alias()])
+        return query.execute().fetchone()[0]
+
+    def _stats_count(self, needed_sets, disallowed_sets, allowed_sets,
+                     from_date, until_date):
+        # unfiltered counts and counts of a single set are read from
+        # the statistics, as long as no record has a datestamp after
+        # the until date
+        set_ids = list(needed_sets or []) + list(allowed_sets or [])
+        if disallowed_sets or from_date is not None or len(set_ids) > 1:
+            return None
+        latest = self._get_stat(u'latest').datestamp
+        if latest is not None and latest > self._until_date(until_date):
+            return None
+        if not set_ids:
+            return self.record_count()
+        row = sql.select([self._sets.c.id],
+                         self._sets.c.set_id == set_ids[0]
+                         ).execute().fetchone()
+        if row is None:
+            return 0
+        stat = self._get_stat(u'set:%s' % row[0])
+        if stat is None:
+            return 0
+        return stat.value
@@ -33,3 +33,6 @@ class DatabaseError(Exception):
     
 class UnknownRecordID(Exception):
     pass
+
+class SchemaVersionError(Exception):
+    pass
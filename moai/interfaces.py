@@ -194,6 +194,22 @@ class IReadOnlyDatabase(Interface):
         If the id does not exist, None is returned
         """
 
+    def generation():
+        """Returns a number that changes whenever the records or sets
+        in the database change, used to invalidate cached responses
+        """
+
+    def latest_datestamp():
+        """Returns a datestamp that no record is modified after, or
+        None if there are no records
+        """
+
+    def get_records(ids):
+        """Returns a list with the get_record() output of every id,
+        in the order of the ids. None is returned for the ids that
+        do not exist.
+        """
+
     def get_metadata(id):
         """Returns a dictionary with additional data.
         Keys are always a string, values are always lists of python
@@ -291,6 +307,37 @@ class IFeedConfig(Interface):
         u"Records in this set will always be served as deleted OAI records "
         "this can be used as an alternative to sets_dissallowed.")
     delay = Attribute(u"number of miliseconds to delay the feed")
+    order = Attribute(
+        u"Order in which records are listed, 'desc' (newest first) "
+        "or 'asc' (oldest first)")
+    render_metadata = Attribute(
+        u"Serve the metadata renditions that were stored by the "
+        "update_moai script, when a record has one")
+    resumption_secret = Attribute(
+        u"Secret used to sign the resumption tokens, tokens are not "
+        "signed when it is not set")
+    compression = Attribute(
+        u"Compress responses with gzip or deflate, when the client "
+        "accepts it")
+    response_cache_size = Attribute(
+        u"Number of OAI-PMH responses kept in memory until the "
+        "database changes, 0 to keep none")
+    response_cache_dir = Attribute(
+        u"Directory in which OAI-PMH responses are stored until the "
+        "database changes, shared by all server processes, or None")
+    asset_chunk_size = Attribute(
+        u"Size in bytes of the chunks in which assets are sent")
+    range_mimetypes = Attribute(
+        u"List of mimetypes of assets that are sent in byte ranges, "
+        "'type/*' matches all subtypes")
+    response_size = Attribute(
+        u"Dictionary of the size in bytes at which ListRecords and "
+        "ListIdentifiers responses are ended, by metadata prefix. "
+        "The None key holds the size for all other prefixes")
+    response_time = Attribute(
+        u"Dictionary of the time in seconds after which ListRecords and "
+        "ListIdentifiers responses are ended, by metadata prefix. "
+        "The None key holds the time for all other prefixes")
 
 
     def get_oai_id(internal_id):
@@ -321,8 +368,10 @@ class IServerRequest(Interface):
         """Redirect to this url
         """
 
-    def send_file(path):
-        """Send the file located at 'path' back to the user
+    def send_file(path, mimetype, chunk_size=None, ranges=False):
+        """Send the file located at 'path' back to the user, streamed
+        in chunks of chunk_size bytes. With ranges the byte ranges
+        requested in a Range header are sent
         """
 
     def query_dict():
@@ -330,8 +379,20 @@ class IServerRequest(Interface):
         request
         """
 
-    def write(data, mimetype):
-        """Write data back to the client
+    def write(data, mimetype, compress=False, etag=None):
+        """Write data back to the client, data is a string or an
+        iterable of strings. With compress the data is compressed
+        with an encoding the client accepts, if any. The etag is
+        sent as validator
+        """
+
+    def not_modified(etag, last_modified=None, compress=False):
+        """Returns True if the If-None-Match or If-Modified-Since
+        headers of the request show that the client has the response
+        """
+
+    def send_not_modified(etag, last_modified=None, compress=False):
+        """Return a 304 Not Modified response
         """
 
     def send_status(code, msg='', mimetype='text/plain'):
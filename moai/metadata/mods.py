@@ -92,10 +92,21 @@ class MODS(object):
             mods.append(MODS.abstract(data['metadata']['description'][0]))
 
 
+        # fetch the related contributor records all at once
+        related = [id for ctype in ['author', 'editor', 'advisor']
+                   for id in data['metadata'].get('%s_rel' % ctype, [])]
+        contributors = {}
+        if related:
+            for record in self.db.get_records(related):
+                if record is not None:
+                    contributors[record['id']] = record['metadata']
+
         for ctype in ['author', 'editor', 'advisor']:
             contributor_data = []
             for id in data['metadata'].get('%s_rel' % ctype, []):
-                contributor = self.db.get_metadata(id)
+                if id not in contributors:
+                    continue
+                contributor = dict(contributors[id])
                 contributor['id'] = id
                 contributor_data.append(contributor)
 
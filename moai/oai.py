@@ -1,13 +1,31 @@
 from pkg_resources import iter_entry_points
 
 from datetime import datetime
+import hashlib
+import hmac
+import itertools
 import pkg_resources
 import time
+import urllib
 
 import oaipmh
+import oaipmh.common
 import oaipmh.metadata
 import oaipmh.server
 import oaipmh.error
+from oaipmh.datestamp import datetime_to_datestamp
+from lxml import etree
+
+from moai.database import HEADER_FIELDS
+
+KEYSET_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# placeholder for the records in a serialized response envelope
+STREAM_MARKER = 'MOAI-RECORDS'
+# placeholder for a stored rendition in a serialized record
+RENDITION_MARKER = 'MOAI-RENDITION'
+# upper bound of the page sizes chosen for a response budget, and of
+# the page size a resumption token can ask for
+MAX_BATCH_SIZE = 1000
 
 def get_writer(prefix, config, db):
     for writer in iter_entry_points(group='moai.format', name=prefix):
@@ -15,6 +33,46 @@ def get_writer(prefix, config, db):
     else:
         raise ValueError('No such metadata format registered: %s' % prefix)
 
+def set_response_date(xml):
+    """Replaces the responseDate of a stored response with the
+    current time"""
+    head, rest = xml.split('<responseDate>', 1)
+    tail = rest.split('</responseDate>', 1)[1]
+    return ''.join([head, '<responseDate>',
+                    datetime_to_datestamp(
+                        datetime.utcnow().replace(microsecond=0)),
+                    '</responseDate>', tail])
+
+def render_metadata(writer, record):
+    """Returns the metadata element a writer creates for a record as
+    an xml string, or None if the writer creates nothing"""
+    element = etree.Element('metadata')
+    metadata = oaipmh.common.Metadata(record)
+    metadata.record = record
+    writer(element, metadata)
+    if not len(element):
+        return None
+    return etree.tostring(element[0])
+
+class RenderedWriter(object):
+    """Wraps a metadata writer, records with a stored rendition of
+    the metadata get that instead of running the writer
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def get_namespace(self):
+        return self.writer.get_namespace()
+
+    def get_schema_location(self):
+        return self.writer.get_schema_location()
+
+    def __call__(self, element, metadata):
+        xml = metadata.record.get('rendition')
+        if xml is None:
+            return self.writer(element, metadata)
+        element.append(etree.fromstring(xml))
+
 
 class OAIServer(object):
     """An OAI-2.0 compliant oai server.
@@ -22,11 +80,25 @@ class OAIServer(object):
     Underlying code is based on pyoai's oaipmh.server'
     """
     
-    def __init__(self, db, config):
+    def __init__(self, db, config, writers=None):
         self.db = db
         self.config = config
+        # the metadata writers by prefix, created by OAIServerFactory
+        self.writers = writers or {}
+        self._identify = None
 
     def identify(self):
+        # pyoai calls identify for the base url of every response, it
+        # is only created again when the database has changed
+        generation = self.db.generation()
+        if self._identify is None or self._identify[0] != generation:
+            self._identify = (generation, self._createIdentify())
+        return self._identify[1]
+
+    def _createIdentify(self):
+        compression = ['identity']
+        if self.config.compression:
+            compression = ['gzip', 'deflate']
         result = oaipmh.common.Identify(
             repositoryName=self.config.name,
             baseURL=self.config.url,
@@ -35,7 +107,7 @@ class OAIServer(object):
             earliestDatestamp=self.db.oai_earliest_datestamp(),
             deletedRecord='transient',
             granularity='YYYY-MM-DDThh:mm:ssZ',
-            compression=['identity'],
+            compression=compression,
             toolkit_description=False)
 
         version = ''
@@ -64,7 +136,9 @@ class OAIServer(object):
     def listMetadataFormats(self, identifier=None):
         result = []
         for prefix in self.config.metadata_prefixes:
-            writer = get_writer(prefix, self.config, self.db)
+            writer = self.writers.get(prefix)
+            if writer is None:
+                writer = get_writer(prefix, self.config, self.db)
             ns = writer.get_namespace()
             schema = writer.get_schema_location()
             result.append((prefix, schema, ns))
@@ -75,25 +149,31 @@ class OAIServer(object):
             yield [set['id'], set['name'], set['description']]
 
     def listRecords(self, metadataPrefix, set=None, from_=None, until=None,
-                    cursor=0, batch_size=10):
+                    cursor=0, batch_size=10, after=None):
         
         self._checkMetadataPrefix(metadataPrefix)
-        for record in self._listQuery(set, from_, until, cursor, batch_size):
+        for record in self._listQuery(set, from_, until, cursor, batch_size,
+                                      after=after,
+                                      rendition=self._rendition(
+                                          metadataPrefix)):
             header, metadata = self._createHeaderAndMetadata(record)
             yield header, metadata, None
 
     def listIdentifiers(self, metadataPrefix, set=None, from_=None, until=None,
-                        cursor=0, batch_size=10):
+                        cursor=0, batch_size=10, after=None):
         
         self._checkMetadataPrefix(metadataPrefix)
-        for record in self._listQuery(set, from_, until, cursor, batch_size):
+        for record in self._listQuery(set, from_, until, cursor, batch_size,
+                                      after=after, fields=HEADER_FIELDS):
             yield self._createHeader(record)
 
     def getRecord(self, metadataPrefix, identifier):
         self._checkMetadataPrefix(metadataPrefix)
         header = None
         metadata = None
-        for record in self._listQuery(identifier=identifier):
+        for record in self._listQuery(identifier=identifier,
+                                      rendition=self._rendition(
+                                          metadataPrefix)):
             header, metadata = self._createHeaderAndMetadata(record)
         if header is None:
             raise oaipmh.error.IdDoesNotExistError(identifier)
@@ -103,6 +183,12 @@ class OAIServer(object):
         if metadataPrefix not in self.config.metadata_prefixes:
             raise oaipmh.error.CannotDisseminateFormatError
 
+    def _rendition(self, metadataPrefix):
+        # the prefix of the stored renditions to use, if any
+        if self.config.render_metadata:
+            return metadataPrefix
+        return None
+
     def _createHeader(self, record):
         deleted = record['deleted']
         for setspec in record['sets']:
@@ -121,7 +207,8 @@ class OAIServer(object):
         return header, metadata
     
     def _listQuery(self, set=None, from_=None, until=None, 
-                   cursor=0, batch_size=10, identifier=None):
+                   cursor=0, batch_size=10, identifier=None, after=None,
+                   fields=None, rendition=None):
             
         now = datetime.utcnow()
         if until != None and until > now:
@@ -141,6 +228,10 @@ class OAIServer(object):
             needed_sets.add(set)
         allowed_sets = self.config.sets_allowed.copy()
         disallowed_sets = self.config.sets_disallowed.copy()    
+
+        if not after is None:
+            # the keyset replaces the offset
+            cursor = 0
         
         return self.db.oai_query(offset=cursor,
                                  batch_size=batch_size,
@@ -149,20 +240,328 @@ class OAIServer(object):
                                  allowed_sets=allowed_sets,
                                  from_date=from_,
                                  until_date=until,
-                                 identifier=identifier
+                                 identifier=identifier,
+                                 after=after,
+                                 fields=fields,
+                                 order=self.config.order,
+                                 rendition=rendition
                                  )
 
+class KeysetResumption(oaipmh.common.ResumptionOAIPMH):
+    """Turns an OAIServer into a ResumptionOAIPMH interface.
+
+    Works like pyoai's BatchingResumption, but the resumption tokens
+    of ListRecords and ListIdentifiers also contain the sort key of the
+    last record on the page. The next page is queried from that key
+    instead of using the cursor as an offset, so every page costs the
+    same no matter how deep the harvest is.
+
+    When the feed has a `resumption_secret` the tokens are signed with
+    an HMAC of that secret, so any server process sharing the secret
+    can resume them and tampered tokens are refused. The tokens do not
+    depend on the state of the database, the keyset resumes correctly
+    after changes.
+    """
+
+    def __init__(self, server, batch_size=10):
+        self._server = server
+        self._batch_size = batch_size
+
+    def handleVerb(self, verb, kw):
+        if verb not in ['ListSets', 'ListIdentifiers', 'ListRecords']:
+            method = oaipmh.common.getMethodForVerb(self._server, verb)
+            return method(**kw)
+        page = self.streamVerb(verb, kw)
+        result = list(page)
+        return result, page.token()
+
+    def streamVerb(self, verb, kw):
+        """Handles a list verb like handleVerb, but returns a
+        :class:`KeysetPage`, which iterates over the items of the page
+        and returns the resumption token after that"""
+        if 'resumptionToken' in kw:
+            kw, cursor = self.decodeToken(kw['resumptionToken'])
+            kw['cursor'] = cursor
+
+        method = oaipmh.common.getMethodForVerb(self._server, verb)
+
+        kw = kw.copy()
+        # the page size chosen for a response budget
+        batch_size = self._batch_size
+        if 'batch_size' in kw:
+            try:
+                batch_size = int(kw.pop('batch_size'))
+            except ValueError:
+                raise oaipmh.error.BadResumptionTokenError(
+                    'Unable to decode resumption token (bad batch size)')
+            batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        cursor = kw.setdefault('cursor', 0)
+        if verb != 'ListSets':
+            kw['after'] = self._decodeKey(kw.pop('after_modified', None),
+                                          kw.pop('after_id', None))
+        # we request 1 beyond the batch size, so that if we retrieve
+        # <= batch_size items, we know we don't need to output another
+        # resumption token
+        results = method(batch_size=batch_size + 1, **kw)
+        return KeysetPage(self, verb, kw, cursor, results, batch_size)
+
+    def _encodeToken(self, verb, kw, cursor, last, batch_size=None):
+        kw = kw.copy()
+        if verb != 'ListSets':
+            del kw['after']
+            header = last
+            if verb == 'ListRecords':
+                header = header[0]
+            kw.update(self._encodeKey(header))
+        if batch_size is not None:
+            kw['batch_size'] = str(batch_size)
+        token = oaipmh.server.encodeResumptionToken(kw, cursor)
+        secret = self._server.config.resumption_secret
+        if secret:
+            # the signature is the last argument of the token, so pyoai
+            # can still decode it, as it does for ListSets responses
+            arguments = urllib.unquote(token)
+            token = urllib.quote('%s&signature=%s' % (
+                arguments, self._sign(secret, arguments)))
+        return token
+
+    def decodeToken(self, token):
+        """Returns the arguments and the cursor of a resumption token,
+        after checking its signature"""
+        secret = self._server.config.resumption_secret
+        if secret:
+            if not isinstance(token, str):
+                token = token.encode('utf8')
+            arguments, sep, signature = urllib.unquote(token).rpartition(
+                '&signature=')
+            if not hmac.compare_digest(self._sign(secret, arguments),
+                                       signature):
+                raise oaipmh.error.BadResumptionTokenError(
+                    'Unable to decode resumption token (bad signature)')
+            token = urllib.quote(arguments)
+        return oaipmh.server.decodeResumptionToken(token)
+
+    def _sign(self, secret, token):
+        return hmac.new(secret, token, hashlib.sha256).hexdigest()
+
+    def _encodeKey(self, header):
+        return {'after_modified': header.datestamp().strftime(
+                    KEYSET_DATE_FORMAT),
+                'after_id': header.identifier()}
+
+    def _decodeKey(self, modified, identifier):
+        if modified is None and identifier is None:
+            return None
+        try:
+            return (datetime.strptime(modified, KEYSET_DATE_FORMAT),
+                    identifier.decode('utf8'))
+        except (TypeError, ValueError, AttributeError):
+            raise oaipmh.error.BadResumptionTokenError(
+                'Unable to decode resumption token (bad sort key)')
+
+class KeysetPage(object):
+    """The items of one page of a list verb, returned by
+    :meth:`KeysetResumption.streamVerb`.
+
+    A consumer can end the page early by calling `stop` after any
+    item, the resumption token then continues after that item.
+    """
+    def __init__(self, resumption, verb, kw, cursor, results, batch_size):
+        self._resumption = resumption
+        self._verb = verb
+        self._kw = kw
+        self._cursor = cursor
+        self._results = iter(results)
+        self._batch_size = batch_size
+        self._last = None
+        self._count = 0
+        self._more = False
+
+    def __iter__(self):
+        for item in self._results:
+            if self._count == self._batch_size:
+                self._more = True
+                break
+            self._last = item
+            self._count += 1
+            yield item
+
+    def stop(self):
+        """Ends the page after the last item that was returned"""
+        if not self._more:
+            for item in self._results:
+                self._more = True
+                break
+
+    def token(self, batch_size=None):
+        """Returns the resumption token of the next page, which has
+        `batch_size` items instead of the configured number if given"""
+        if not self._more:
+            return None
+        return self._resumption._encodeToken(
+            self._verb, self._kw, self._cursor + self._count, self._last,
+            batch_size)
+
+class KeysetBatchingServer(oaipmh.server.ServerBase):
+    """A pyoai BatchingServer that resumes with a keyset instead of
+    an offset.
+
+    ListRecords and ListIdentifiers responses are returned as an
+    iterator of strings, which serializes one record at a time while
+    the response is sent, instead of building the whole page as one
+    xml tree.
+
+    When the feed has a response size or time budget for the metadata
+    prefix, a page ends after the record that reaches the budget, and
+    the resumption token asks for as many records as are expected to
+    fit in the budget of the next page.
+    """
+    def __init__(self, server, metadata_registry=None, nsmap=None,
+                 resumption_batch_size=10):
+        self._server = server
+        self._resumption = KeysetResumption(server, resumption_batch_size)
+        self._identify = None
+        super(KeysetBatchingServer, self).__init__(
+            self._resumption,
+            metadata_registry,
+            nsmap)
+
+    def handleVerb(self, verb, kw):
+        if verb == 'Identify':
+            return self._identifyResponse()
+        if verb not in ['ListIdentifiers', 'ListRecords']:
+            return super(KeysetBatchingServer, self).handleVerb(verb, kw)
+        page = self._resumption.streamVerb(verb, kw)
+        items = iter(page)
+        # errors have to be raised before the response starts, so
+        # the first item is fetched here
+        try:
+            first = [items.next()]
+        except StopIteration:
+            first = []
+            if not 'resumptionToken' in kw:
+                raise oaipmh.error.NoRecordsMatchError(
+                    'No records match for request.')
+        return self._streamResponse(verb, kw, page,
+                                    itertools.chain(first, items))
+
+    def _identifyResponse(self):
+        # the serialized response is kept until the database changes,
+        # only the responseDate is filled in for every request
+        generation = self._server.db.generation()
+        if self._identify is None or self._identify[0] != generation:
+            self._identify = (generation, super(
+                KeysetBatchingServer, self).handleVerb('Identify', {}))
+        return set_response_date(self._identify[1])
+
+    def _streamResponse(self, verb, kw, page, items):
+        tree_server = self._tree_server
+        envelope, element = tree_server._outputEnvelope(verb=verb, **kw)
+        # the envelope is serialized once, and split where the
+        # records go
+        element.text = STREAM_MARKER
+        head, tail = etree.tostring(envelope.getroot(),
+                                    encoding='UTF-8',
+                                    xml_declaration=True,
+                                    pretty_print=True).rsplit(STREAM_MARKER, 1)
+        element.text = None
+        yield head + '\n'
+
+        token_kw = kw
+        if 'resumptionToken' in kw:
+            token_kw = self._resumption.decodeToken(
+                kw['resumptionToken'])[0]
+        config = self._server.config
+        prefix = token_kw['metadataPrefix']
+        max_size = config.response_size.get(
+            prefix, config.response_size.get(None))
+        max_time = config.response_time.get(
+            prefix, config.response_time.get(None))
+        start = time.time()
+        size = count = 0
+        for item in items:
+            rendition = None
+            if verb == 'ListRecords':
+                header, metadata, about = item
+                e_record = etree.SubElement(element,
+                                            oaipmh.server.nsoai('record'))
+                tree_server._outputHeader(e_record, header)
+                if not header.isDeleted():
+                    rendition = metadata.record.get('rendition')
+                if rendition is not None:
+                    # the stored xml is copied into the response
+                    # instead of being parsed and serialized again
+                    etree.SubElement(e_record, oaipmh.server.nsoai(
+                        'metadata')).text = RENDITION_MARKER
+                elif not header.isDeleted():
+                    tree_server._outputMetadata(
+                        e_record, token_kw['metadataPrefix'], metadata)
+            else:
+                tree_server._outputHeader(element, item)
+                e_record = element[-1]
+            data = self._serializeChild(element, e_record)
+            element.remove(e_record)
+            if rendition is not None:
+                if isinstance(rendition, unicode):
+                    rendition = rendition.encode('utf-8')
+                data = rendition.join(data.rsplit(RENDITION_MARKER, 1))
+            size += len(data)
+            count += 1
+            yield data
+            if ((max_size and size >= max_size) or
+                (max_time and time.time() - start >= max_time)):
+                page.stop()
+                break
+
+        batch_size = None
+        if (max_size or max_time) and count:
+            batch_size = self._budgetBatchSize(
+                count, size, time.time() - start, max_size, max_time)
+        token = page.token(batch_size)
+        if token is not None:
+            e_token = etree.SubElement(
+                element, oaipmh.server.nsoai('resumptionToken'))
+            e_token.text = token
+            yield self._serializeChild(element, e_token)
+        yield tail
+
+    def _budgetBatchSize(self, count, size, duration, max_size, max_time):
+        # the number of records of the same average size and
+        # duration as those of this page that fit in the budget
+        batch_size = MAX_BATCH_SIZE
+        if max_size:
+            batch_size = min(batch_size, max_size * count / size)
+        if max_time and duration > 0:
+            batch_size = min(batch_size, int(max_time * count / duration))
+        return max(1, batch_size)
+
+    def _serializeChild(self, element, child):
+        # lxml repeats the namespace declarations of the envelope on
+        # every serialized child, they are removed by comparing with
+        # the serialization of an empty element
+        empty = etree.SubElement(element, child.tag)
+        start = etree.tostring(empty, encoding='UTF-8')[:-2]
+        element.remove(empty)
+        data = etree.tostring(child, encoding='UTF-8', pretty_print=True)
+        if data.startswith(start):
+            data = start.split(' ', 1)[0] + data[len(start):]
+        return data
+
 def OAIServerFactory(db, config):
     """Create a new OAI batching OAI Server given a config and
-    a database"""
+    a database. The server can be reused for all requests to the
+    feed, the metadata writers are only looked up here."""
     
     metadata_registry = oaipmh.metadata.MetadataRegistry()
+    writers = {}
     for prefix in config.metadata_prefixes:
-        metadata_registry.registerWriter(prefix,
-                                         get_writer(prefix, config, db))
+        # records without a stored rendition are passed on to the
+        # writer, so wrapping is harmless when render_metadata is off
+        writers[prefix] = RenderedWriter(get_writer(prefix, config, db))
+        metadata_registry.registerWriter(prefix, writers[prefix])
             
-    return oaipmh.server.BatchingServer(
-        OAIServer(db, config),
+    return KeysetBatchingServer(
+        OAIServer(db, config, writers),
         metadata_registry=metadata_registry,
         resumption_batch_size=config.batch_size
         )
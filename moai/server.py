@@ -7,11 +7,16 @@ of :ref:`IServer` and :ref:`IFeedConfig`.
 
 """
 import os
+import urllib
+import datetime
+import hashlib
 import tempfile
 
 import oaipmh.error
+from paste.deploy.converters import asbool
 
-from moai.oai import OAIServerFactory, OAIServer
+from moai.oai import OAIServerFactory, OAIServer, set_response_date
+from moai.cache import ResponseCache
 
 class Server(object):
     """This is the default implementation of the
@@ -24,6 +29,8 @@ class Server(object):
         self.base_url = base_url
         self._db = db
         self._config = config
+        self._oai_server = None
+        self._response_cache = None
 
     def download_asset(self, req, url, config):
         """Download an asset
@@ -46,8 +53,25 @@ class Server(object):
                 '404 File not Found',
                 'The asset file "%s" does not exist' % filename)
 
+        mimetype = asset['mimetype'].encode('ascii')
         return req.send_file(asset['path'],
-                             asset['mimetype'].encode('ascii'))
+                             mimetype,
+                             chunk_size=config.asset_chunk_size,
+                             ranges=self.allow_ranges(mimetype, config))
+
+    def allow_ranges(self, mimetype, config):
+        """Returns a boolean indicating if byte ranges of assets with
+        this mimetype can be requested, which allows resuming downloads.
+
+        The range_mimetypes of the config can contain mimetypes like
+        'application/zip', or all subtypes of a type like 'video/*'
+        """
+        for allowed in config.range_mimetypes:
+            if allowed == mimetype or (
+                allowed.endswith('/*') and
+                mimetype.startswith(allowed[:-1])):
+                return True
+        return False
 
     def allow_download(self, url, config):
         """Returns a boolean indicating if it is okay to download an
@@ -114,8 +138,106 @@ class Server(object):
                 return req.send_status('403 Forbidden',
                                        'You are not allowed to download this asset')
 
-        oai_server = OAIServerFactory(self._db, self._config)
-        return req.write(oai_server.handleRequest(req.query_dict()), 'text/xml')
+        query = req.query_dict()
+        compress = self._config.compression
+        etag = self.response_etag(query)
+        if etag is not None and req.not_modified(etag, compress=compress):
+            return req.send_not_modified(etag, compress=compress)
+        return req.write(self.oai_response(query), 'text/xml',
+                         compress=compress, etag=etag)
+
+    def response_etag(self, query):
+        """Returns the ETag of the response to a GetRecord or ListSets
+        query, which changes with the database generation, or None for
+        other queries and while responses are time dependent.
+
+        There is no Last-Modified date, the modified date of a record
+        does not change when its sets or related records change.
+        """
+        if query.get('verb') not in ['GetRecord', 'ListSets']:
+            return None
+        if self.time_dependent():
+            return None
+        return hashlib.sha1('%s&generation=%s' % (
+            query_key(query), self._db.generation())).hexdigest()
+
+    def oai_response(self, query):
+        """Returns the OAI-PMH response to a query dictionary, from the
+        response cache when the feed has one and the database did not
+        change since the response was stored
+        """
+        cache = self.get_response_cache()
+        if cache is None or self.time_dependent():
+            return self.get_oai_server().handleRequest(query)
+        key = query_key(query)
+        generation = self._db.generation()
+        data = cache.get(key, generation)
+        if data is not None:
+            return set_response_date(data)
+        data = self.get_oai_server().handleRequest(query)
+        if isinstance(data, basestring):
+            cache.put(key, generation, data)
+            return data
+        return self._cache_iter(data, cache, key, generation)
+
+    def _cache_iter(self, data, cache, key, generation):
+        # streamed responses are stored when they are sent completely
+        chunks = []
+        for chunk in data:
+            chunks.append(chunk)
+            yield chunk
+        cache.put(key, generation, ''.join(chunks))
+
+    def time_dependent(self):
+        """Returns True if responses can change without a change of the
+        database, because records with a datestamp in the future become
+        visible when it has passed, or because the feed has a delay
+        """
+        if self._config.delay:
+            return True
+        latest = self._db.latest_datestamp()
+        return latest is not None and latest > datetime.datetime.utcnow()
+
+    def get_response_cache(self):
+        """Returns the response cache of the feed, or None when the
+        feed does not cache responses
+        """
+        if self._response_cache is None:
+            size = self._config.response_cache_size
+            directory = self._config.response_cache_dir
+            if size > 0 or directory:
+                self._response_cache = ResponseCache(size, directory)
+        return self._response_cache
+
+    def get_oai_server(self):
+        """Returns the OAI server of the feed, it is created by the
+        first request and reused after that
+        """
+        if self._oai_server is None:
+            self._oai_server = OAIServerFactory(self._db, self._config)
+        return self._oai_server
+
+def query_key(query):
+    """Returns a string that is the same for all query dictionaries
+    with the same arguments"""
+    items = []
+    for name, value in sorted(query.items()):
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        items.append((name, value))
+    return urllib.urlencode(items)
+
+def prefix_values(value, convert):
+    """Parses a setting like '1000000 didl:5000000' into a dictionary
+    of values by metadata prefix, the value without a prefix is stored
+    under None and applies to all other prefixes"""
+    result = {}
+    for item in (value or '').split():
+        prefix = None
+        if ':' in item:
+            prefix, item = item.split(':', 1)
+        result[prefix] = convert(item)
+    return result
 
 class FeedConfig(object):
     """The feedconfig object contains all the settings for a specific
@@ -147,6 +269,31 @@ class FeedConfig(object):
         self.sets_deleted = set(sets_deleted or [])
         self.filter_sets = set(filter_sets or [])
         self.delay = extra_args.get('delay', 0)
+        # 'asc' serves the oldest changes first, which keeps harvests
+        # stable while the database is updated
+        self.order = extra_args.get('order', 'desc')
+        # serve the metadata renditions stored by update_moai
+        self.render_metadata = asbool(extra_args.get('render_metadata',
+                                                     False))
+        # signs the resumption tokens, shared by all server processes
+        self.resumption_secret = extra_args.get('resumption_secret')
+        # gzip or deflate responses for clients that accept them
+        self.compression = asbool(extra_args.get('compression', True))
+        # stores responses until the database changes
+        self.response_cache_size = int(extra_args.get(
+            'response_cache_size', 0))
+        self.response_cache_dir = extra_args.get('response_cache_dir')
+        # size of the chunks in which assets are sent
+        self.asset_chunk_size = int(extra_args.get('asset_chunk_size',
+                                                   65536))
+        # mimetypes of the assets that are sent in byte ranges
+        self.range_mimetypes = (extra_args.get('range_mimetypes')
+                                or '').split()
+        # budgets of list responses, in bytes and seconds
+        self.response_size = prefix_values(
+            extra_args.get('response_size'), int)
+        self.response_time = prefix_values(
+            extra_args.get('response_time'), float)
         self.base_asset_path = extra_args.get('base_asset_path',
                                               tempfile.gettempdir())
         self.oai_id_prefix = extra_args.get('oai_id_prefix', '')
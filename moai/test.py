@@ -1,18 +1,29 @@
 # coding=utf8
 import os
+import shutil
+import re
 from unittest import TestCase, TestSuite, makeSuite
 import doctest
 import datetime
+import tempfile
 import urllib2
+import zlib
 
 from lxml import etree
+import sqlalchemy as sql
 import wsgi_intercept
+from webob import Request
 from wsgi_intercept.urllib2_intercept import install_opener
 
 from moai.utils import XPath
-from moai.database import Database
-from moai.server import Server, FeedConfig
-from moai.wsgi import MOAIWSGIApp
+from moai.database import (SQLDatabase as Database, migrate_database,
+                           SCHEMA_VERSION, HEADER_FIELDS)
+from moai.error import SchemaVersionError
+from moai.server import Server, FeedConfig, prefix_values, query_key
+from moai.oai import get_writer, render_metadata
+from moai.cache import ResponseCache
+from moai.bitmap import SetBitmapIndex
+from moai.wsgi import MOAIWSGIApp, WSGIRequest, parse_ranges
 from moai.provider.file import FileBasedContentProvider
 from moai.example import ExampleContent
 install_opener()
@@ -129,6 +140,81 @@ class DatabaseTest(TestCase):
         self.db.remove_record(u'oai:spam')
         self.assertEquals(self.db.record_count(), 0)
         
+    def test_flush_existing(self):
+        # a flush mixing new and existing records and sets
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {u'spam': dict(name=u'spamset')},
+                              {u'title': u'Spam!'})
+        self.db.flush()
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2010, 10, 14, 12, 30, 00),
+                              False, {u'spam': dict(name=u'Spam Set')},
+                              {u'title': u'More Spam!'})
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2010, 10, 14, 12, 30, 00),
+                              False, {u'ham': dict(name=u'hamset'),
+                                      u'spam': dict(name=u'Spam Set')},
+                              {u'title': u'Ham!'})
+        self.db.flush()
+        self.assertEquals(self.db.record_count(), 2)
+        self.assertEquals(self.db.set_count(), 2)
+        self.assertEquals(self.db.get_record(u'oai:spam')['metadata'],
+                          {u'title': u'More Spam!'})
+        self.assertEquals(self.db.get_set(u'spam')['name'], u'Spam Set')
+        self.assertEquals(self.db.get_record(u'oai:ham')['sets'],
+                          [u'ham', u'spam'])
+
+    def test_flush_replace(self):
+        # the delete and insert fallback gives the same results as the
+        # upsert flush
+        db = Database(config={'upsert': 'false'})
+        self.failIf(db._upsert)
+        self.failUnless(self.db._upsert)
+        for database in [self.db, db]:
+            database.update_record(u'oai:spam',
+                                   datetime.datetime(2010, 10, 13, 12, 30),
+                                   False, {u'spam': dict(name=u'spamset'),
+                                           u'ham': dict(name=u'hamset')},
+                                   {u'title': u'Spam!'})
+            database.flush()
+            database.update_record(u'oai:spam',
+                                   datetime.datetime(2010, 10, 14, 12, 30),
+                                   True, {u'ham': dict(name=u'Ham Set')},
+                                   {u'title': u'Ham!'})
+            database.flush()
+        self.assertEquals(db.get_record(u'oai:spam'),
+                          self.db.get_record(u'oai:spam'))
+        self.assertEquals(db.get_record(u'oai:spam')['sets'], [u'ham'])
+        self.assertEquals(db.get_set(u'ham'), self.db.get_set(u'ham'))
+        self.assertEquals(db.get_set(u'ham')['name'], u'Ham Set')
+
+    def test_metadata_codec(self):
+        db = Database(config={'metadata_codec': 'zlib'})
+        metadata = {u'title': [u'Spam!'] * 100,
+                    u'date': [datetime.datetime(2010, 10, 13, 12, 30)]}
+        db.update_record(u'oai:spam',
+                         datetime.datetime(2010, 10, 13, 12, 30, 00),
+                         False, {}, metadata)
+        db.flush()
+        value = db._records.select().execute().fetchone().metadata
+        self.failUnless(value.startswith('zlib:'))
+        self.assertEquals(db.get_record(u'oai:spam')['metadata'],
+                          {u'title': [u'Spam!'] * 100,
+                           u'date': [u'2010-10-13T12:30:00']})
+        # records stored with another codec can still be read, and
+        # can be converted in place
+        db._records.update(values={'metadata': u'{"title": ["Ham!"]}'}
+                           ).execute()
+        self.assertEquals(db.get_record(u'oai:spam')['metadata'],
+                          {u'title': [u'Ham!']})
+        self.assertEquals(db.recode_metadata(), 1)
+        self.assertEquals(db.recode_metadata(), 0)
+        value = db._records.select().execute().fetchone().metadata
+        self.failUnless(value.startswith('zlib:'))
+        self.assertEquals(list(db.oai_query())[0]['metadata'],
+                          {u'title': [u'Ham!']})
+
     def test_setrefs(self):
         # add a record that references a set
         self.assertEquals(self.db.set_count(), 0)
@@ -196,6 +282,27 @@ class DatabaseTest(TestCase):
                             'id': u'spamset',
                             'name': u'Spam Set'}] )
 
+    def test_oai_query_setrefs(self):
+        # the sets of all records in a page are fetched at once,
+        # hidden sets are left out
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {u'spam': dict(name=u'spamset'),
+                                      u'test': dict(name=u'testset',
+                                                    hidden=True)}, {})
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {u'ham': dict(name=u'hamset'),
+                                      u'spam': dict(name=u'spamset')}, {})
+        self.db.update_record(u'oai:eggs',
+                              datetime.datetime(2008, 10, 13, 12, 30, 00),
+                              False, {}, {})
+        self.db.flush()
+        self.assertEquals([(r['id'], r['sets']) for r in self.db.oai_query()],
+                          [(u'oai:ham', [u'ham', u'spam']),
+                           (u'oai:spam', [u'spam']),
+                           (u'oai:eggs', [])])
+
     def test_earliest_datestamp(self):
         self.assertEquals(self.db.oai_earliest_datestamp(),
                           datetime.datetime(1970, 1, 1, 0, 0))
@@ -261,6 +368,27 @@ class DatabaseTest(TestCase):
             )],
             [u'oai:spam', u'oai:ham'])
 
+    def test_oai_query_fields(self):
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2010, 01, 01, 00, 00, 00),
+                              False, {u'spamset':{u'name':u'spam'}},
+                              {u'title': [u'Spam!']})
+        self.db.flush()
+        # header only queries do not read the metadata
+        self.assertEquals(
+            list(self.db.oai_query(
+            fields=('id', 'modified', 'deleted', 'sets'))),
+            [{'deleted': False,
+              'sets': [u'spamset'],
+              'id': u'oai:spam',
+              'modified': datetime.datetime(2010, 1, 1, 0, 0)}])
+        self.assertEquals(
+            list(self.db.oai_query(fields=('id', 'metadata'))),
+            [{'deleted': False,
+              'metadata': {u'title': [u'Spam!']},
+              'id': u'oai:spam',
+              'modified': datetime.datetime(2010, 1, 1, 0, 0)}])
+
     def test_oai_query_identifier(self):
         self.db.update_record(u'oai:spam',
                               datetime.datetime(2010, 01, 01, 00, 00, 00),
@@ -352,6 +480,459 @@ class DatabaseTest(TestCase):
         self.assertEquals([r['id'] for r in self.db.oai_query(
             batch_size=1, offset=2)], [u'oai:spamspamspam'])
 
+    def test_oai_count(self):
+        self.assertEquals(self.db.oai_count(), 0)
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {u'spam': dict(name=u'spamset'),
+                                      u'test': dict(name=u'testset')}, {})
+        self.db.update_record(u'oai:spamspamspam',
+                              datetime.datetime(2009, 06, 13, 12, 30, 00),
+                              False, {u'spam': dict(name=u'spamset')}, {})
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {u'ham': dict(name=u'hamset'),
+                                      u'test': dict(name=u'testset')}, {})
+        self.db.flush()
+        self.assertEquals(self.db.oai_count(), 3)
+        self.assertEquals(self.db.oai_count(needed_sets=[u'spam']), 2)
+        self.assertEquals(self.db.oai_count(allowed_sets=[u'ham', u'test'],
+                                            disallowed_sets=[u'spam']), 1)
+        self.assertEquals(self.db.oai_count(
+            from_date=datetime.datetime(2009, 10, 13, 12, 30, 00)), 2)
+        self.db.remove_record(u'oai:ham')
+        self.assertEquals(self.db.oai_count(needed_sets=[u'test']), 1)
+
+    def test_stats(self):
+        generation = self.db.generation()
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {u'spam': dict(name=u'spamset')}, {})
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {u'spam': dict(name=u'spamset'),
+                                      u'ham': dict(name=u'hamset')}, {})
+        self.db.flush()
+        self.assertNotEquals(self.db.generation(), generation)
+        self.assertEquals(self.db.oai_count(needed_sets=[u'spam']), 2)
+        # a flush without changes keeps the generation, and with it
+        # the caches
+        generation = self.db.generation()
+        self.db.flush()
+        self.db.remove_record(u'oai:eggs')
+        self.db.remove_set(u'eggs')
+        self.assertEquals(self.db.generation(), generation)
+        # updating the earliest record moves the earliest datestamp
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2011, 10, 13, 12, 30, 00),
+                              False, {u'ham': dict(name=u'hamset')}, {})
+        self.db.flush()
+        self.assertEquals(self.db.record_count(), 2)
+        self.assertEquals(self.db.oai_earliest_datestamp(),
+                          datetime.datetime(2010, 10, 13, 12, 30))
+        self.assertEquals(self.db.oai_count(needed_sets=[u'spam']), 1)
+        self.assertEquals(self.db.oai_count(allowed_sets=[u'ham']), 2)
+        self.db.remove_record(u'oai:ham')
+        self.assertEquals(self.db.oai_earliest_datestamp(),
+                          datetime.datetime(2011, 10, 13, 12, 30))
+        self.assertEquals(self.db.oai_count(needed_sets=[u'spam']), 0)
+        self.db.remove_set(u'spam')
+        self.assertEquals(self.db.set_count(), 1)
+        # rebuilding gives the same statistics
+        stats = self.db._stats.select().execute().fetchall()
+        self.db.rebuild_stats()
+        self.assertEquals(
+            sorted([tuple(row) for row in stats if row.name != u'generation']),
+            sorted([tuple(row) for row in self.db._stats.select().execute()
+                    if row.name != u'generation']))
+
+    def test_get_records(self):
+        self.db.update_record(u'oai:spam',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {u'spam': dict(name=u'spamset')},
+                              {u'title': [u'Spam!']})
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {}, {u'title': [u'Ham!']})
+        self.db.flush()
+        records = self.db.get_records([u'oai:ham', u'oai:eggs', u'oai:spam'])
+        self.assertEquals(records[0], self.db.get_record(u'oai:ham'))
+        self.assertEquals(records[1], None)
+        self.assertEquals(records[2],
+                          {'id': u'oai:spam',
+                           'deleted': False,
+                           'modified': datetime.datetime(
+                               2009, 10, 13, 12, 30, 00),
+                           'metadata': {u'title': [u'Spam!']},
+                           'sets': [u'spam']})
+        self.assertEquals(self.db.get_records([]), [])
+
+    def test_renditions(self):
+        for id in [u'oai:spam', u'oai:ham']:
+            self.db.update_record(id,
+                                  datetime.datetime(2009, 10, 13, 12, 30, 00),
+                                  False, {u'spam': dict(name=u'spamset')},
+                                  {u'title': [id]})
+        self.db.update_record(u'oai:eggs',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              True, {}, {})
+        self.db.flush()
+        render = lambda record: '<title>%s</title>' % (
+            record['metadata']['title'][0])
+        # deleted records are not rendered
+        self.assertEquals(self.db.render_metadata(u'test', render), 2)
+        self.assertEquals(self.db.render_metadata(u'test', render), 0)
+        records = list(self.db.oai_query(identifier=u'oai:ham',
+                                         rendition=u'test'))
+        self.assertEquals(records[0]['rendition'], '<title>oai:ham</title>')
+        self.assertEquals(records[0]['sets'], [u'spam'])
+        self.assertFalse('metadata' in records[0])
+        self.assertFalse('rendition' in list(self.db.oai_query(
+            identifier=u'oai:ham', rendition=u'other'))[0])
+        # changed records lose their renditions
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {}, {u'title': [u'Ham!']})
+        self.db.flush()
+        self.db.remove_record(u'oai:spam')
+        self.assertEquals([r.get('rendition') for r in
+                           self.db.oai_query(rendition=u'test')],
+                          [None, None])
+        self.assertEquals(self.db.render_metadata(u'test', render), 1)
+        self.assertEquals([r.get('rendition') for r in
+                           self.db.oai_query(rendition=u'test')],
+                          ['<title>Ham!</title>', None])
+        self.db.clear_renditions()
+        self.assertEquals(self.db.render_metadata(u'test', render), 1)
+        # renditions that show related records are removed when those
+        # change, or are added
+        self.db.update_record(u'oai:bacon',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {}, {u'title': [u'Bacon'],
+                                          u'author_rel': [u'oai:ham',
+                                                          u'oai:pig']})
+        self.db.flush()
+        self.assertEquals(self.db.render_metadata(u'test', render), 1)
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2011, 10, 13, 12, 30, 00),
+                              False, {}, {u'title': [u'Ham!!']})
+        self.db.flush()
+        self.assertEquals(self.db.render_metadata(u'test', render), 2)
+        self.db.update_record(u'oai:pig',
+                              datetime.datetime(2011, 10, 13, 12, 30, 00),
+                              False, {}, {u'title': [u'Pig']})
+        self.db.flush()
+        self.assertEquals(self.db.render_metadata(u'test', render), 2)
+        self.db.remove_record(u'oai:pig')
+        self.assertEquals(self.db.render_metadata(u'test', render), 1)
+
+    def test_changes(self):
+        self.assertEquals(self.db.last_sequence(), 0)
+        self.assertEquals(self.db.get_changes(), [])
+        for id in [u'oai:spam', u'oai:ham', u'oai:eggs']:
+            self.db.update_record(id,
+                                  datetime.datetime(2009, 10, 13, 12, 30, 00),
+                                  False, {u'spam': dict(name=u'spamset')},
+                                  {u'title': [id]})
+        self.db.flush()
+        sequence = self.db.last_sequence()
+        self.assertEquals(sequence, 3)
+        self.assertEquals(self.db.get_changes(after=1, batch_size=1),
+                          [{'seq': 2,
+                            'id': u'oai:ham',
+                            'removed': False,
+                            'deleted': False,
+                            'modified': datetime.datetime(
+                                2009, 10, 13, 12, 30, 00),
+                            'sets': [u'spam'],
+                            'metadata': {u'title': [u'oai:ham']}}])
+        # only the last change of a record is kept
+        self.db.update_record(u'oai:eggs',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              True, {}, {})
+        self.db.flush()
+        self.db.remove_record(u'oai:ham')
+        self.assertEquals([(c['seq'], c['id'], c['removed']) for c in
+                           self.db.get_changes(after=sequence,
+                                               fields=HEADER_FIELDS)],
+                          [(4, u'oai:eggs', False), (5, u'oai:ham', True)])
+        self.assertEquals(self.db.get_changes(after=4)[0],
+                          {'seq': 5, 'id': u'oai:ham', 'removed': True})
+        # removing a set changes the records in it
+        self.db.remove_set(u'spam')
+        self.assertEquals([c['id'] for c in self.db.get_changes(after=5)],
+                          [u'oai:spam'])
+
+    def test_initialize(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        uri = 'sqlite:///%s' % path
+        try:
+            db = Database(uri)
+            db.update_record(u'oai:spam',
+                             datetime.datetime(2010, 10, 13, 12, 30, 00),
+                             False, {}, {'title': [u'Spam!']})
+            db.flush()
+            # a database without stats, like one from an older version,
+            # is only counted by the scripts
+            db._stats.delete().execute()
+            self.assertRaises(SchemaVersionError, Database, uri)
+            self.assertEquals(migrate_database(uri), SCHEMA_VERSION)
+            db = Database(uri)
+            self.assertEquals(db.record_count(), 1)
+            self.assertEquals(db.last_sequence(), 1)
+            # another process can add a stat between the update and the
+            # insert
+            other = Database(uri)
+            db._stats.delete(db._stats.c.name == u'records').execute()
+            insert = db._stats.insert
+            def racing_insert():
+                other._set_stat(u'records', 5)
+                return insert()
+            db._stats.insert = racing_insert
+            try:
+                db._add_stat(u'records', 1)
+            finally:
+                del db._stats.insert
+            self.assertEquals(db.record_count(), 6)
+        finally:
+            os.remove(path)
+
+    def test_migrate(self):
+        # create a database with the version 1 schema, which used the
+        # oai ids as keys
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        uri = 'sqlite:///%s' % path
+        db = sql.MetaData(sql.create_engine(uri))
+        records = sql.Table('records', db,
+                  sql.Column('record_id', sql.Unicode, primary_key=True),
+                  sql.Column('modified', sql.DateTime, index=True),
+                  sql.Column('deleted', sql.Boolean),
+                  sql.Column('metadata', sql.String))
+        sets = sql.Table('sets', db,
+                  sql.Column('set_id', sql.Unicode, primary_key=True),
+                  sql.Column('hidden', sql.Boolean),
+                  sql.Column('name', sql.Unicode),
+                  sql.Column('description', sql.Unicode))
+        setrefs = sql.Table('setrefs', db,
+                  sql.Column('record_id', sql.Integer,
+                             sql.ForeignKey('records.record_id'),
+                             index=True, primary_key=True),
+                  sql.Column('set_id', sql.Integer,
+                             sql.ForeignKey('sets.set_id'),
+                             index=True, primary_key=True))
+        db.create_all()
+        records.insert().execute(
+            record_id=u'oai:spam',
+            modified=datetime.datetime(2010, 10, 13, 12, 30, 00),
+            deleted=False, metadata='{"title": ["Spam!"]}')
+        sets.insert().execute(set_id=u'spam', hidden=False, name=u'spamset')
+        setrefs.insert().execute(record_id=u'oai:spam', set_id=u'spam')
+        db.bind.dispose()
+        try:
+            self.assertRaises(SchemaVersionError, Database, uri)
+            self.assertEquals(migrate_database(uri), 1)
+            self.assertEquals(migrate_database(uri), SCHEMA_VERSION)
+            db = Database(uri)
+            self.assertEquals(db.record_count(), 1)
+            self.assertEquals([c['id'] for c in db.get_changes()],
+                              [u'oai:spam'])
+            self.assertEquals(db.get_record(u'oai:spam'),
+                              {'id': u'oai:spam',
+                               'deleted': False,
+                               'modified': datetime.datetime(
+                                   2010, 10, 13, 12, 30, 00),
+                               'metadata': {u'title': [u'Spam!']},
+                               'sets': [u'spam']})
+            self.assertEquals([r['id'] for r in db.oai_query(
+                needed_sets=[u'spam'])], [u'oai:spam'])
+        finally:
+            os.remove(path)
+
+    def test_oai_keyset_batching(self):
+        # records with the same datestamp are ordered by their id
+        for id in [u'oai:a', u'oai:b', u'oai:c']:
+            self.db.update_record(id,
+                                  datetime.datetime(2009, 10, 13, 12, 30, 00),
+                                  False, {}, {})
+        self.db.update_record(u'oai:d',
+                              datetime.datetime(2008, 10, 13, 12, 30, 00),
+                              False, {}, {})
+        self.db.flush()
+        self.assertEquals([r['id'] for r in self.db.oai_query()],
+                          [u'oai:c', u'oai:b', u'oai:a', u'oai:d'])
+        # resume after the last record of the previous page
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            batch_size=2,
+            after=(datetime.datetime(2009, 10, 13, 12, 30, 00), u'oai:b'))],
+                          [u'oai:a', u'oai:d'])
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            after=(datetime.datetime(2008, 10, 13, 12, 30, 00), u'oai:d'))],
+                          [])
+
+    def test_oai_query_ascending(self):
+        for id in [u'oai:a', u'oai:b', u'oai:c']:
+            self.db.update_record(id,
+                                  datetime.datetime(2009, 10, 13, 12, 30, 00),
+                                  False, {u'spam': dict(name=u'spamset')}, {})
+        self.db.update_record(u'oai:d',
+                              datetime.datetime(2008, 10, 13, 12, 30, 00),
+                              False, {u'spam': dict(name=u'spamset')}, {})
+        self.db.flush()
+        self.assertEquals([r['id'] for r in self.db.oai_query(order='asc')],
+                          [u'oai:d', u'oai:a', u'oai:b', u'oai:c'])
+        self.assertEquals([r['id'] for r in self.db.oai_query(
+            order='asc', batch_size=1, offset=1, needed_sets=[u'spam'])],
+                          [u'oai:a'])
+        page = [r['id'] for r in self.db.oai_query(
+            order='asc', batch_size=2,
+            after=(datetime.datetime(2009, 10, 13, 12, 30, 00), u'oai:a'))]
+        self.assertEquals(page, [u'oai:b', u'oai:c'])
+        self.assertRaises(ValueError, list, self.db.oai_query(order='spam'))
+
+    def test_oai_select_resumed_plan(self):
+        # resumed pages in both orders are read from a range of the
+        # composite index, without sorting the matching records
+        engine = self.db._db.bind
+        after = (datetime.datetime(2009, 10, 13, 12, 30), u'oai:spam')
+        for order, bound in [('asc', 'modified>?'), ('desc', 'modified<?')]:
+            query = self.db._oai_select(fields=HEADER_FIELDS, order=order,
+                                        after=after).limit(10)
+            compiled = query.compile(bind=engine)
+            params = compiled.construct_params()
+            plan = ' '.join([list(row)[-1] for row in engine.execute(
+                'EXPLAIN QUERY PLAN %s' % compiled,
+                tuple([params[name] for name in compiled.positiontup]))])
+            self.assert_('records_modified_record_id' in plan, plan)
+            self.assert_(bound in plan, plan)
+            self.failIf('TEMP B-TREE' in plan, plan)
+
+    def test_oai_query_ascending_update(self):
+        # records that change during a harvest move to the end, so
+        # resuming never skips a record
+        for i in range(4):
+            self.db.update_record(u'oai:%s' % i,
+                                  datetime.datetime(2009, 10, 13, 12, 30, i),
+                                  False, {}, {})
+        self.db.flush()
+        page = list(self.db.oai_query(order='asc', batch_size=2))
+        self.db.update_record(u'oai:0',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {}, {})
+        self.db.update_record(u'oai:3',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {}, {})
+        self.db.flush()
+        last = page[-1]
+        page += list(self.db.oai_query(
+            order='asc', after=(last['modified'], last['id'])))
+        self.assertEquals([r['id'] for r in page],
+                          [u'oai:0', u'oai:1', u'oai:2', u'oai:0', u'oai:3'])
+
+class IndexedDatabaseTest(DatabaseTest):
+    # run all database tests again, using the set bitmap index
+    def setUp(self):
+        self.db = Database(config={'set_index': 'true'})
+
+    def test_set_index_order(self):
+        # the rows can come in the collation order of the database,
+        # the index uses python ordering
+        day = datetime.datetime(2009, 10, 13)
+        index = SetBitmapIndex()
+        index.build([(day, u'oai:b'), (day, u'oai:B'), (day, u'oai:a')],
+                    [(u'oai:a', u's'), (u'oai:b', u's'), (u'oai:B', u't')])
+        self.assertEquals(index.select(index.candidates(), order='asc'),
+                          [u'oai:B', u'oai:a', u'oai:b'])
+        self.assertEquals(index.select(index.candidates(
+            after=(day, u'oai:a'), order='asc'), order='asc'), [u'oai:b'])
+        self.assertEquals(index.select(index.candidates(
+            needed_sets=[u's'])), [u'oai:b', u'oai:a'])
+        # a new index is built after a change, the old one stays usable
+        self.db.update_record(u'oai:spam', day, False, {}, {})
+        self.db.flush()
+        old = self.db._get_set_index()
+        self.db.update_record(u'oai:ham', day, False, {}, {})
+        self.db.flush()
+        self.failIf(self.db._get_set_index() is old)
+        self.assertEquals(old.select(old.candidates()), [u'oai:spam'])
+
+class CachedDatabaseTest(DatabaseTest):
+    # run all database tests again, with a record cache
+    def setUp(self):
+        self.db = Database(config={'record_cache_size': '2'})
+
+    def test_record_cache(self):
+        for id in [u'oai:spam', u'oai:ham', u'oai:eggs']:
+            self.db.update_record(id,
+                                  datetime.datetime(2009, 10, 13, 12, 30, 00),
+                                  False, {u'spam': dict(name=u'spamset')},
+                                  {u'title': [id]})
+        self.db.flush()
+        self.db.get_records([u'oai:spam', u'oai:ham'])
+        self.assertEquals(self.db.record_cache_info(),
+                          {'hits': 0, 'misses': 2, 'size': 2, 'maxsize': 2})
+        self.db.get_record(u'oai:spam')
+        # oai_query reads the page from the cache as well
+        list(self.db.oai_query(identifier=u'oai:spam'))
+        self.assertEquals(self.db.record_cache_info()['hits'], 2)
+        # the least recently used record is dropped
+        self.db.get_record(u'oai:eggs')
+        self.assertEquals(self.db.record_cache_info()['size'], 2)
+        self.db.get_record(u'oai:ham')
+        self.assertEquals(self.db.record_cache_info()['misses'], 4)
+        # changed records are never served from the cache
+        self.db.update_record(u'oai:ham',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              True, {}, {u'title': [u'Ham!']})
+        self.db.flush()
+        self.assertEquals(self.db.get_record(u'oai:ham')['metadata'],
+                          {u'title': [u'Ham!']})
+        self.assertEquals(self.db.record_cache_info()['size'], 2)
+        self.db.remove_set(u'spam')
+        self.assertEquals(self.db.get_record(u'oai:eggs')['sets'], [])
+        self.db.remove_record(u'oai:eggs')
+        self.assertEquals(self.db.get_record(u'oai:eggs'), None)
+
+    def test_record_cache_hidden_set(self):
+        self.db.update_record(u'oai:a',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {u's': dict(name=u'set')},
+                              {u'title': [u'A']})
+        self.db.flush()
+        self.assertEquals(self.db.get_record(u'oai:a')['sets'], [u's'])
+        # hiding the set with another record changes the cached record
+        self.db.update_record(u'oai:b',
+                              datetime.datetime(2009, 10, 14, 12, 30, 00),
+                              False, {u's': dict(name=u'set', hidden=True)},
+                              {u'title': [u'B']})
+        self.db.flush()
+        self.assertEquals(self.db.get_record(u'oai:a')['sets'], [])
+        self.assertEquals([record['sets'] for record in
+                           self.db.oai_query()], [[], []])
+
+    def test_record_cache_other_process(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        uri = 'sqlite:///%s' % path
+        try:
+            db = Database(uri, config={'record_cache_size': '10'})
+            db.update_record(u'oai:spam',
+                             datetime.datetime(2009, 10, 13, 12, 30, 00),
+                             False, {}, {u'title': [u'Spam!']})
+            db.flush()
+            self.assertEquals(db.get_record(u'oai:spam')['metadata'],
+                              {u'title': [u'Spam!']})
+            updater = Database(uri)
+            updater.update_record(u'oai:spam',
+                                  datetime.datetime(2009, 10, 13, 12, 30, 00),
+                                  False, {}, {u'title': [u'Spam?']})
+            updater.flush()
+            self.assertEquals(db.get_record(u'oai:spam')['metadata'],
+                              {u'title': [u'Spam?']})
+        finally:
+            os.remove(path)
+
 class ProviderTest(TestCase):
     def setUp(self):
         path = os.path.abspath(os.path.dirname(__file__))
@@ -449,6 +1030,488 @@ class ServerTest(TestCase):
         self.assertEquals(xpath.strings('//oai:identifier'),
                           [u'oai:spam', u'oai:spamspamspam'])
 
+    def harvest_identifiers(self):
+        ids = []
+        url = 'http://test?verb=ListIdentifiers&metadataPrefix=oai_dc'
+        while True:
+            doc = etree.fromstring(urllib2.urlopen(url).read())
+            xpath = XPath(doc, nsmap=
+                          {"oai": "http://www.openarchives.org/OAI/2.0/"})
+            ids.extend(xpath.strings('//oai:identifier'))
+            token = xpath.string('//oai:resumptionToken')
+            if not token:
+                break
+            url = ('http://test?verb=ListIdentifiers&resumptionToken=%s' %
+                   urllib2.quote(token))
+        return ids
+
+    def test_list_identifiers_resumption(self):
+        self.config.batch_size = 1
+        self.assertEquals(self.harvest_identifiers(),
+                          [u'oai:ham', u'oai:spam', u'oai:spamspamspam'])
+        self.config.order = 'asc'
+        self.assertEquals(self.harvest_identifiers(),
+                          [u'oai:spamspamspam', u'oai:spam', u'oai:ham'])
+
+    def test_signed_resumption_tokens(self):
+        self.config.batch_size = 1
+        self.config.resumption_secret = 'secret'
+        self.assertEquals(self.harvest_identifiers(),
+                          [u'oai:ham', u'oai:spam', u'oai:spamspamspam'])
+        xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
+                              '&metadataPrefix=oai_dc').read()
+        xpath = XPath(etree.fromstring(xml), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        token = xpath.string('//oai:resumptionToken')
+        # the tokens do not change with the database
+        self.db.update_record(u'oai:eggs',
+                              datetime.datetime(2004, 10, 13, 12, 30, 00),
+                              False, {}, {'title': [u'Eggs!']})
+        self.db.flush()
+        xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
+                              '&metadataPrefix=oai_dc').read()
+        xpath = XPath(etree.fromstring(xml), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.string('//oai:resumptionToken'), token)
+        def error(token):
+            xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
+                                  '&resumptionToken=%s' %
+                                  urllib2.quote(token)).read()
+            xpath = XPath(etree.fromstring(xml), nsmap=
+                          {"oai": "http://www.openarchives.org/OAI/2.0/"})
+            return xpath.string('//oai:error/@code')
+        self.assertEquals(error(token), None)
+        # changed and unsigned tokens are refused
+        self.assertEquals(error(token.replace('oai_dc', 'mods')),
+                          u'badResumptionToken')
+        self.assertEquals(error(urllib2.unquote(token).rpartition(
+            '&signature=')[0]),
+                          u'badResumptionToken')
+        # as are tokens signed with another secret
+        self.config.resumption_secret = 'other secret'
+        self.assertEquals(error(token), u'badResumptionToken')
+
+    def test_signed_list_sets(self):
+        self.config.batch_size = 1
+        self.config.resumption_secret = 'secret'
+        sets = []
+        url = 'http://test?verb=ListSets'
+        while True:
+            doc = etree.fromstring(urllib2.urlopen(url).read())
+            xpath = XPath(doc, nsmap=
+                          {"oai": "http://www.openarchives.org/OAI/2.0/"})
+            self.assertEquals(xpath.string('//oai:error/@code'), None)
+            sets.extend(xpath.strings('//oai:setSpec'))
+            token = xpath.string('//oai:resumptionToken')
+            if not token:
+                break
+            url = ('http://test?verb=ListSets&resumptionToken=%s' %
+                   urllib2.quote(token))
+        self.assertEquals(sorted(sets), [u'ham', u'spam', u'test'])
+
+    def test_response_budget(self):
+        self.assertEquals(prefix_values('1000 didl:5000', int),
+                          {None: 1000, 'didl': 5000})
+        self.assertEquals(prefix_values(None, float), {})
+        # a large budget asks for larger pages than the configured size
+        self.config.batch_size = 1
+        self.config.response_size = prefix_values('1000000', int)
+        xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
+                              '&metadataPrefix=oai_dc').read()
+        xpath = XPath(etree.fromstring(xml), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        token = xpath.string('//oai:resumptionToken')
+        self.assert_('batch_size=1000' in urllib2.unquote(token))
+        xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
+                              '&resumptionToken=%s' %
+                              urllib2.quote(token)).read()
+        xpath = XPath(etree.fromstring(xml), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.strings('//oai:identifier'),
+                          [u'oai:spam', u'oai:spamspamspam'])
+        # every record is larger than the budget, so every page ends
+        # after one record and asks for pages of one record
+        self.config.response_size = prefix_values('mods:1 oai_dc:1', int)
+        xml = urllib2.urlopen('http://test?verb=ListIdentifiers'
+                              '&resumptionToken=%s' %
+                              urllib2.quote(token)).read()
+        xpath = XPath(etree.fromstring(xml), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.strings('//oai:identifier'), [u'oai:spam'])
+        token = urllib2.unquote(xpath.string('//oai:resumptionToken'))
+        self.assert_('batch_size=1&' in token or
+                     token.endswith('batch_size=1'))
+        self.assertEquals(self.harvest_identifiers(),
+                          [u'oai:ham', u'oai:spam', u'oai:spamspamspam'])
+
+    def test_rendered_metadata(self):
+        def titles():
+            xml = urllib2.urlopen('http://test?verb=ListRecords'
+                                  '&metadataPrefix=oai_dc').read()
+            xpath = XPath(etree.fromstring(xml), nsmap=
+                          {"dc": "http://purl.org/dc/elements/1.1/"})
+            return xpath.strings('//dc:title')
+        writer = get_writer('oai_dc', self.config, self.db)
+        self.assertEquals(self.db.render_metadata(
+            u'oai_dc', lambda record: render_metadata(writer, record)), 3)
+        # change a rendition, to see that they are used
+        self.db._renditions.update(values={
+            'xml': sql.func.replace(self.db._renditions.c.xml,
+                                    'Ham!', 'Rendered ham!')}).execute()
+        self.assertEquals(titles(), [u'Ham!', u'Spam!', u'Spam Spam Spam!'])
+        self.config.render_metadata = True
+        self.assertEquals(titles(),
+                          [u'Rendered ham!', u'Spam!', u'Spam Spam Spam!'])
+        # the stored xml is copied into the response as it is
+        xml = urllib2.urlopen('http://test?verb=ListRecords'
+                              '&metadataPrefix=oai_dc').read()
+        for row in self.db._renditions.select().execute():
+            self.assert_(row.xml.encode('utf-8') in xml)
+        self.db.clear_renditions()
+        self.assertEquals(titles(), [u'Ham!', u'Spam!', u'Spam Spam Spam!'])
+
+    def test_oai_server_reused(self):
+        import moai.oai
+        calls = []
+        get_writer = moai.oai.get_writer
+        def counting_get_writer(*args):
+            calls.append(args[0])
+            return get_writer(*args)
+        moai.oai.get_writer = counting_get_writer
+        try:
+            for query in ['verb=ListRecords&metadataPrefix=oai_dc',
+                          'verb=ListRecords&metadataPrefix=mods',
+                          'verb=ListMetadataFormats',
+                          'verb=ListMetadataFormats']:
+                xml = urllib2.urlopen('http://test?%s' % query).read()
+                self.failIf('<error' in xml)
+        finally:
+            moai.oai.get_writer = get_writer
+        # the writers are only looked up once
+        self.assertEquals(calls, ['oai_dc', 'mods', 'didl'])
+        self.assert_(self.server.get_oai_server() is
+                     self.server.get_oai_server())
+
+    def test_identify_cached(self):
+        import moai.oai
+        calls = []
+        create = moai.oai.OAIServer._createIdentify
+        def counting_create(server):
+            calls.append(server)
+            return create(server)
+        moai.oai.OAIServer._createIdentify = counting_create
+        try:
+            first = urllib2.urlopen('http://test?verb=Identify').read()
+            urllib2.urlopen('http://test?verb=ListSets').read()
+            second = urllib2.urlopen('http://test?verb=Identify').read()
+            self.assertEquals(len(calls), 1)
+            # the response date is filled in for every response
+            date = re.compile('<responseDate>[^<]*</responseDate>')
+            self.assertEquals(date.sub('', first), date.sub('', second))
+            self.assertEquals(len(date.findall(second)), 1)
+            # a change of the database creates the response again
+            self.db.update_record(u'oai:eggs',
+                                  datetime.datetime(2004, 10, 13, 12, 30, 00),
+                                  False, {}, {'title': [u'Eggs!']})
+            self.db.flush()
+            xml = urllib2.urlopen('http://test?verb=Identify').read()
+        finally:
+            moai.oai.OAIServer._createIdentify = create
+        self.assertEquals(len(calls), 2)
+        xpath = XPath(etree.fromstring(xml), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.string('//oai:earliestDatestamp'),
+                          u'2004-10-13T12:30:00Z')
+
+    def test_streaming_response(self):
+        request = Request.blank('http://test?verb=ListRecords'
+                                '&metadataPrefix=oai_dc')
+        response = self.server.handle_request(WSGIRequest(request))
+        # the header, every record and the footer are separate chunks
+        chunks = list(response.app_iter)
+        self.assertEquals(len(chunks), 5)
+        xpath = XPath(etree.fromstring(''.join(chunks)), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.strings('//oai:record/oai:header/'
+                                        'oai:identifier'),
+                          [u'oai:ham', u'oai:spam', u'oai:spamspamspam'])
+        # errors are found before the response starts
+        request = Request.blank('http://test?verb=ListRecords'
+                                '&metadataPrefix=oai_dc&set=eggs')
+        response = self.server.handle_request(WSGIRequest(request))
+        xpath = XPath(etree.fromstring(response.body), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.string('//oai:error/@code'),
+                          u'noRecordsMatch')
+
+    def test_compression(self):
+        def response(query, encoding=None):
+            request = Request.blank('http://test?%s' % query)
+            if encoding is not None:
+                request.headers['Accept-Encoding'] = encoding
+            response = self.server.handle_request(WSGIRequest(request))
+            return response, ''.join(response.app_iter)
+        # the responses only differ in their response date
+        date = re.compile('<responseDate>[^<]*</responseDate>')
+        def same(first, second):
+            self.assertEquals(date.sub('', first), date.sub('', second))
+        plain = response('verb=ListRecords&metadataPrefix=oai_dc')[1]
+        result, data = response('verb=ListRecords&metadataPrefix=oai_dc',
+                                'gzip')
+        self.assertEquals(result.content_encoding, 'gzip')
+        self.assertEquals(result.headers['Vary'], 'Accept-Encoding')
+        same(zlib.decompress(data, 16 + zlib.MAX_WBITS), plain)
+        result, data = response('verb=ListRecords&metadataPrefix=oai_dc',
+                                'gzip;q=0.5, deflate')
+        self.assertEquals(result.content_encoding, 'deflate')
+        same(zlib.decompress(data), plain)
+        result, data = response('verb=ListRecords&metadataPrefix=oai_dc',
+                                'identity')
+        self.assertEquals(result.content_encoding, None)
+        same(data, plain)
+        # string responses are compressed as well
+        result, data = response('verb=Identify', 'deflate')
+        self.assertEquals(result.content_encoding, 'deflate')
+        xpath = XPath(etree.fromstring(zlib.decompress(data)), nsmap=
+                      {"oai": "http://www.openarchives.org/OAI/2.0/"})
+        self.assertEquals(xpath.strings('//oai:compression'),
+                          [u'gzip', u'deflate'])
+        self.config.compression = False
+        result, data = response('verb=ListRecords&metadataPrefix=oai_dc',
+                                'gzip')
+        self.assertEquals(result.content_encoding, None)
+        same(data, plain)
+
+    def test_response_cache(self):
+        self.assertEquals(query_key({'verb': u'GetRecord',
+                                     'identifier': u'oai:spam'}),
+                          query_key({'identifier': u'oai:spam',
+                                     'verb': u'GetRecord'}))
+        directory = tempfile.mkdtemp()
+        self.config.response_cache_size = 10
+        self.config.response_cache_dir = directory
+        calls = []
+        def counting(server):
+            handle_request = server.get_oai_server().handleRequest
+            def counting_handle_request(query):
+                calls.append(query)
+                return handle_request(query)
+            server.get_oai_server().handleRequest = counting_handle_request
+        counting(self.server)
+        date = re.compile('<responseDate>[^<]*</responseDate>')
+        def titles(query):
+            xml = urllib2.urlopen('http://test?%s' % query).read()
+            self.assertEquals(len(date.findall(xml)), 1)
+            xpath = XPath(etree.fromstring(xml), nsmap=
+                          {"dc": "http://purl.org/dc/elements/1.1/"})
+            return xpath.strings('//dc:title')
+        try:
+            query = 'verb=ListRecords&metadataPrefix=oai_dc'
+            self.assertEquals(titles(query),
+                              [u'Ham!', u'Spam!', u'Spam Spam Spam!'])
+            self.assertEquals(titles(query),
+                              [u'Ham!', u'Spam!', u'Spam Spam Spam!'])
+            self.assertEquals(titles('metadataPrefix=oai_dc&verb=GetRecord'
+                                     '&identifier=oai:spam'), [u'Spam!'])
+            self.assertEquals(len(calls), 2)
+            # other processes find the responses on disk
+            server = Server('http://test', self.db, self.config)
+            counting(server)
+            self.app.server = server
+            self.assertEquals(titles(query),
+                              [u'Ham!', u'Spam!', u'Spam Spam Spam!'])
+            self.assertEquals(len(calls), 2)
+            # changes of the database are never hidden by the cache
+            self.db.update_record(u'oai:spam',
+                                  datetime.datetime(2009, 10, 13, 12, 30, 00),
+                                  False, {}, {'title': [u'New spam!']})
+            self.db.flush()
+            self.assertEquals(titles(query),
+                              [u'Ham!', u'New spam!', u'Spam Spam Spam!'])
+            self.assertEquals(len(calls), 3)
+            self.assertEquals(len(os.listdir(directory)), 1)
+            # a record in the future becomes visible without a change of
+            # the database, so responses are not cached until then
+            self.db.update_record(u'oai:eggs',
+                                  datetime.datetime.utcnow() +
+                                  datetime.timedelta(days=1),
+                                  False, {}, {'title': [u'Eggs!']})
+            self.db.flush()
+            self.failUnless(server.time_dependent())
+            titles(query)
+            titles(query)
+            self.assertEquals(len(calls), 5)
+            self.db.remove_record(u'oai:eggs')
+            self.failIf(server.time_dependent())
+            self.config.delay = 10
+            self.failUnless(server.time_dependent())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_response_cache_generations(self):
+        directory = tempfile.mkdtemp()
+        try:
+            first = ResponseCache(0, directory)
+            second = ResponseCache(0, directory)
+            first.put('k1', 5, 'five')
+            second.put('k1', 6, 'six')
+            self.assertEquals(os.listdir(directory), ['6'])
+            # a response computed before the change is not stored,
+            # and does not remove the newer responses
+            first.put('k2', 5, 'five')
+            self.assertEquals(os.listdir(directory), ['6'])
+            self.assertEquals(second.get('k1', 6), 'six')
+            self.assertEquals(first.get('k2', 5), None)
+            # failing to store a response is not an error
+            shutil.rmtree(directory)
+            open(directory, 'w').close()
+            first.put('k3', 7, 'seven')
+            self.assertEquals(first.get('k3', 7), None)
+        finally:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            else:
+                os.remove(directory)
+
+    def test_conditional_requests(self):
+        def response(query, **headers):
+            request = Request.blank('http://test?%s' % query,
+                                    headers=headers)
+            return self.server.handle_request(WSGIRequest(request))
+        query = 'verb=GetRecord&metadataPrefix=oai_dc&identifier=oai:spam'
+        result = response(query)
+        etag = result.etag
+        self.assertEquals(result.last_modified, None)
+        result = response(query, **{'If-None-Match': '"%s"' % etag})
+        self.assertEquals(result.status_int, 304)
+        self.assertEquals(result.body, '')
+        self.assertEquals(result.etag, etag)
+        result = response(query, **{'If-None-Match': '*'})
+        self.assertEquals(result.status_int, 304)
+        # the modified date of the record does not cover its sets
+        result = response(query, **{'If-Modified-Since':
+                                    'Tue, 13 Oct 2009 12:30:00 GMT'})
+        self.assertEquals(result.status_int, 200)
+        self.db.remove_set(u'spam')
+        result = response(query, **{'If-None-Match': '"%s"' % etag})
+        self.assertEquals(result.status_int, 200)
+        etag = result.etag
+        # the compressed response has another ETag
+        result = response(query, **{'Accept-Encoding': 'gzip'})
+        self.assertEquals(result.etag, etag + '-gzip')
+        result = response(query, **{'Accept-Encoding': 'gzip',
+                                    'If-None-Match': '"%s"' % etag})
+        self.assertEquals(result.status_int, 200)
+        # ListSets has an ETag, list verbs have none
+        etag = response('verb=ListSets').etag
+        self.assertNotEquals(etag, None)
+        self.assertEquals(response('verb=ListIdentifiers'
+                                   '&metadataPrefix=oai_dc').etag, None)
+        # any change of the database changes the ETags
+        self.db.update_record(u'oai:eggs',
+                              datetime.datetime(2004, 10, 13, 12, 30, 00),
+                              False, {u'eggs': dict(name=u'eggset')},
+                              {'title': [u'Eggs!']})
+        self.db.flush()
+        result = response('verb=ListSets', **{'If-None-Match': '"%s"' % etag})
+        self.assertEquals(result.status_int, 200)
+        self.assertNotEquals(result.etag, etag)
+        # responses that change with the time have no ETag
+        self.db.update_record(u'oai:future',
+                              datetime.datetime.utcnow() +
+                              datetime.timedelta(days=1),
+                              False, {}, {'title': [u'Later']})
+        self.db.flush()
+        self.assertEquals(response(query).etag, None)
+        result = response(query, **{'If-None-Match': '*'})
+        self.assertEquals(result.status_int, 200)
+
+    def test_send_file(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write('x' * 10000)
+            request = WSGIRequest(Request.blank('http://test'))
+            response = request.send_file(path, 'application/pdf',
+                                         chunk_size=4000)
+            self.assertEquals([len(chunk) for chunk in response.app_iter],
+                              [4000, 4000, 2000])
+            self.assertEquals(response.content_length, 10000)
+            # the file wrapper of the wsgi server is used if there is one
+            class FileWrapper(object):
+                def __init__(self, fileobj, chunk_size):
+                    self.fileobj = fileobj
+                    self.chunk_size = chunk_size
+            request = WSGIRequest(Request.blank('http://test', environ={
+                'wsgi.file_wrapper': FileWrapper}))
+            response = request.send_file(path, 'application/pdf',
+                                         chunk_size=4000)
+            self.assert_(isinstance(response.app_iter, FileWrapper))
+            self.assertEquals(response.app_iter.chunk_size, 4000)
+            response.app_iter.fileobj.close()
+        finally:
+            os.remove(path)
+
+    def test_send_file_ranges(self):
+        self.assertEquals(parse_ranges('bytes=0-99, 200-, -50', 1000),
+                          [(0, 100), (200, 1000), (950, 1000)])
+        self.assertEquals(parse_ranges('bytes=2000-', 1000), [])
+        self.assertEquals(parse_ranges('bytes=10-5', 1000), None)
+        self.assertEquals(parse_ranges('lines=1-2', 1000), None)
+        self.config.range_mimetypes = ['application/zip', 'video/*']
+        self.failUnless(self.server.allow_ranges('video/mp4', self.config))
+        self.failIf(self.server.allow_ranges('application/pdf', self.config))
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(''.join([chr(i) for i in range(256)]) * 4)
+            data = open(path, 'rb').read()
+            def response(ranges, **headers):
+                request = WSGIRequest(Request.blank('http://test',
+                                                    headers=headers))
+                response = request.send_file(path, 'application/zip',
+                                             chunk_size=100, ranges=ranges)
+                return response, ''.join(response.app_iter)
+            result, body = response(False, Range='bytes=0-9')
+            self.assertEquals(result.status_int, 200)
+            self.assertEquals(result.headers['Accept-Ranges'], 'none')
+            self.assertEquals(body, data)
+            result, body = response(True, Range='bytes=1000-')
+            self.assertEquals(result.status_int, 206)
+            self.assertEquals(result.headers['Accept-Ranges'], 'bytes')
+            self.assertEquals(result.headers['Content-Range'],
+                              'bytes 1000-1023/1024')
+            self.assertEquals(body, data[1000:])
+            self.assertEquals(result.content_length, 24)
+            result, body = response(True, Range='bytes=0-9,-10')
+            self.assertEquals(result.status_int, 206)
+            self.assertEquals(result.content_length, len(body))
+            boundary = result.headers['Content-Type'].split('boundary=')[1]
+            self.assertEquals(body.split('--%s' % boundary)[1:], [
+                '\r\nContent-Type: application/zip\r\n'
+                'Content-Range: bytes 0-9/1024\r\n\r\n%s\r\n' % data[:10],
+                '\r\nContent-Type: application/zip\r\n'
+                'Content-Range: bytes 1014-1023/1024\r\n\r\n%s\r\n' % (
+                    data[-10:]),
+                '--\r\n'])
+            result, body = response(True, Range='bytes=2000-')
+            self.assertEquals(result.status_int, 416)
+            self.assertEquals(result.headers['Content-Range'], 'bytes */1024')
+            # ranges of a file that changed are not sent
+            result, body = response(True, Range='bytes=0-9', **{
+                'If-Range': 'Mon, 12 Oct 2009 12:30:00 GMT'})
+            self.assertEquals(result.status_int, 200)
+            self.assertEquals(body, data)
+            last_modified = result.headers['Last-Modified']
+            result, body = response(True, Range='bytes=0-9', **{
+                'If-Range': last_modified})
+            self.assertEquals(result.status_int, 206)
+            result, body = response(True, **{
+                'If-Modified-Since': last_modified})
+            self.assertEquals(result.status_int, 304)
+        finally:
+            os.remove(path)
+
     def test_list_records(self):
         xml = urllib2.urlopen('http://test?verb=ListRecords'
                               '&metadataPrefix=oai_dc').read()
@@ -469,6 +1532,27 @@ class ServerTest(TestCase):
         self.assertEquals(xpath.strings('//mods:titleInfo/mods:title'),
                           [u'Ham!', u'Spam!', u'Spam Spam Spam!'])
         
+    def test_mods_contributors(self):
+        self.db.update_record(u'oai:john',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {}, {'name': [u'John Doe'],
+                                          'surname': [u'Doe']})
+        self.db.update_record(u'oai:eggs',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {}, {'title': [u'Eggs!'],
+                                          'author_rel': [u'oai:john'],
+                                          'editor_rel': [u'oai:john']})
+        self.db.flush()
+        xml = urllib2.urlopen('http://test?verb=GetRecord'
+                              '&metadataPrefix=mods'
+                              '&identifier=oai:eggs').read()
+        xpath = XPath(etree.fromstring(xml), nsmap=
+                      {"mods": "http://www.loc.gov/mods/v3"})
+        self.assertEquals(xpath.strings('//mods:name/mods:displayForm'),
+                          [u'John Doe', u'John Doe'])
+        self.assertEquals(xpath.strings('//mods:roleTerm'),
+                          [u'aut', u'edt'])
+
     def test_list_sets(self):
         xml = urllib2.urlopen('http://test?verb=ListSets').read()
         doc = etree.fromstring(xml)
@@ -510,6 +1594,8 @@ def suite():
     test_suite = TestSuite()
     test_suite.addTest(makeSuite(XPathUtilTest))
     test_suite.addTest(makeSuite(DatabaseTest))
+    test_suite.addTest(makeSuite(IndexedDatabaseTest))
+    test_suite.addTest(makeSuite(CachedDatabaseTest))
     test_suite.addTest(makeSuite(ProviderTest))
     test_suite.addTest(makeSuite(ServerTest))
     # note that tests of the oai protocol itself are done in the
@@ -8,36 +8,20 @@ import ConfigParser
 
 from optparse import OptionParser
 
+from paste.deploy.converters import asbool
+
 from moai.utils import (get_duration,
                         get_moai_log,
                         ProgressBar)
-from moai.database import SQLDatabase
+from moai.database import SQLDatabase, migrate_database, SCHEMA_VERSION
+from moai.oai import get_writer, render_metadata
+from moai.wsgi import feed_config_factory
 
 VERSION = pkg_resources.working_set.by_key['moai'].version
                  
-def update_moai():
-    usage = "usage: %prog [options] profilename"
-    version = "%%prog %s" % VERSION
-
-    parser = OptionParser(usage, version=version)
-
-    parser.add_option("-v", "--verbose", dest="verbose",
-                      help="print logging at info level",
-                      action="store_true")
-    parser.add_option('-d', '--debug', dest='debug',
-                      help="print traceback and quit on error",
-                      action='store_true')
-    parser.add_option("-q", "--quiet", dest="quiet",
-                      help="be quiet, do not output and info",
-                      action="store_true")
-    parser.add_option("", "--config", dest="config",
-                      help="specify settings file",
-                      action="store")
-    parser.add_option("", "--date", dest="from_date",
-                      help="Only update database from a specific date",
-                      action="store")
-        
-    options, args = parser.parse_args()
+def read_profile(options, args):
+    """Returns the settings of the profile named in the commandline
+    arguments, as a dictionary. Exits if the profile can not be found"""
     if not len(args):
         profile_name = 'default'
     else:
@@ -74,6 +58,57 @@ def update_moai():
             sys.stderr.write('unknown profile: %s\n' % profile_name)
         sys.stderr.write('(known profiles are: %s)\n' % ', '.join(profiles))
         sys.exit(1)
+    return config
+
+def render_formats(database, config, log, debug=False):
+    """Stores a rendition of the metadata in every format of the profile
+    for the records that do not have one yet"""
+    feedconfig = feed_config_factory(**config)
+    for prefix in feedconfig.metadata_prefixes:
+        writer = get_writer(prefix, feedconfig, database)
+        def render(record):
+            try:
+                return render_metadata(writer, record)
+            except Exception, err:
+                if debug:
+                    raise
+                log.error('Error rendering %s as %s: %s' % (
+                    record['id'], prefix, str(err)))
+        count = database.render_metadata(prefix, render)
+        log.info('Rendered %s records as %s' % (count, prefix))
+
+def update_moai():
+    usage = "usage: %prog [options] profilename"
+    version = "%%prog %s" % VERSION
+
+    parser = OptionParser(usage, version=version)
+
+    parser.add_option("-v", "--verbose", dest="verbose",
+                      help="print logging at info level",
+                      action="store_true")
+    parser.add_option('-d', '--debug', dest='debug',
+                      help="print traceback and quit on error",
+                      action='store_true')
+    parser.add_option("-q", "--quiet", dest="quiet",
+                      help="be quiet, do not output and info",
+                      action="store_true")
+    parser.add_option("", "--config", dest="config",
+                      help="specify settings file",
+                      action="store")
+    parser.add_option("", "--date", dest="from_date",
+                      help="Only update database from a specific date",
+                      action="store")
+    parser.add_option("", "--recode-metadata", dest="recode_metadata",
+                      help="re-encode stored metadata with the configured "
+                      "metadata_codec and quit",
+                      action="store_true")
+    parser.add_option("", "--render-metadata", dest="render_metadata",
+                      help="render the metadata of all records in all "
+                      "formats again and quit",
+                      action="store_true")
+        
+    options, args = parser.parse_args()
+    config = read_profile(options, args)
 
     if options.from_date:
         if 'T' in options.from_date:
@@ -85,7 +120,17 @@ def update_moai():
     else:
         from_date = None
 
-    database = SQLDatabase(config['database'])
+    database = SQLDatabase(config['database'], config, initialize=True)
+
+    if options.recode_metadata:
+        count = database.recode_metadata()
+        print >> sys.stderr, 'Re-encoded metadata of %s records' % count
+        return
+
+    if options.render_metadata:
+        database.clear_renditions()
+        render_formats(database, config, get_moai_log(), options.debug)
+        return
 
     ContentClass = None
     for content_point in iter_entry_points(group='moai.content',
@@ -185,6 +230,9 @@ def update_moai():
         
     log.info('Flushing database')
     database.flush()
+    if asbool(config.get('render_metadata', False)):
+        log.info('Rendering metadata')
+        render_formats(database, config, log, options.debug)
     duration = get_duration(starttime)
     print >> sys.stderr, ''
     msg = 'Updating database with %s objects took %s' % (total, duration)
@@ -200,3 +248,26 @@ def update_moai():
         if not options.verbose and not options.quiet:
             print >> sys.stderr, msg
 
+def migrate_moai():
+    usage = "usage: %prog [options] profilename"
+    version = "%%prog %s" % VERSION
+
+    parser = OptionParser(usage, version=version)
+    parser.add_option("", "--config", dest="config",
+                      help="specify settings file",
+                      action="store")
+
+    options, args = parser.parse_args()
+    config = read_profile(options, args)
+
+    starttime = time.time()
+    old_version = migrate_database(config['database'])
+    if old_version is None:
+        print >> sys.stderr, 'Database is empty, nothing to migrate'
+    elif old_version == SCHEMA_VERSION:
+        print >> sys.stderr, ('Database already has schema version %s' %
+                              SCHEMA_VERSION)
+    else:
+        print >> sys.stderr, (
+            'Migrated database from schema version %s to %s in %s' % (
+            old_version, SCHEMA_VERSION, get_duration(starttime)))
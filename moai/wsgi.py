@@ -1,10 +1,21 @@
 import os
+import zlib
+import uuid
+import datetime
 
 from webob import Request, Response
 
 from moai.server import Server, FeedConfig
 from moai.database import get_database
 
+# content encodings of compressed responses, in order of preference,
+# with the zlib window bits of their format
+COMPRESSION_WBITS = [('gzip', 16 + zlib.MAX_WBITS),
+                     ('deflate', zlib.MAX_WBITS)]
+COMPRESSION_LEVEL = 6
+# requests for more byte ranges get the whole file
+MAX_RANGES = 20
+
 class WSGIRequest(object):
     """This is a request object that can be used in a WSGI environment.
     It implements :ref:`IServerRequest` interface.
@@ -23,19 +34,74 @@ class WSGIRequest(object):
         response.location = url
         return response
 
-    def send_file(self, path, mimetype):
-        """Send the file located at 'path' back to the user
+    def send_file(self, path, mimetype, chunk_size=None, ranges=False):
+        """Send the file located at 'path' back to the user, the file
+        is streamed with the file wrapper of the WSGI server if it has
+        one, so it can use sendfile, or else in chunks of chunk_size.
+        With ranges the byte ranges of a Range header are sent.
         """
-        response = Response(content_type=mimetype,
-                            conditional_response=True)
-        response.last_modified = os.path.getmtime(path)
-        response.app_iter = FileIterable(path)
-        with open(path) as f:
-            response.body = f.read()
-        response.content_length = os.path.getsize(path)
-        # do not accept ranges, since this does not work reliable
-        # with acrobat IE plugin
-        response.headers['Accept-Ranges'] = 'none'
+        chunk_size = chunk_size or FileIterator.chunk_size
+        last_modified = datetime.datetime.utcfromtimestamp(
+            os.path.getmtime(path))
+        if self.not_modified(None, last_modified):
+            return self.send_not_modified(None, last_modified)
+        length = os.path.getsize(path)
+        response = Response(content_type=mimetype)
+        response.last_modified = last_modified
+        if not ranges:
+            # do not accept ranges, since this does not work reliable
+            # with acrobat IE plugin
+            response.headers['Accept-Ranges'] = 'none'
+        else:
+            response.headers['Accept-Ranges'] = 'bytes'
+            byte_ranges = self._byte_ranges(response, length)
+            if byte_ranges == []:
+                response.status = 416
+                response.headers['Content-Range'] = 'bytes */%s' % length
+                del response.content_type
+                return response
+            if byte_ranges is not None:
+                return self._send_ranges(response, path, mimetype, length,
+                                         byte_ranges, chunk_size)
+        file_wrapper = self._req.environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            response.app_iter = file_wrapper(open(path, 'rb'), chunk_size)
+        else:
+            response.app_iter = FileIterable(path, chunk_size=chunk_size)
+        response.content_length = length
+        return response
+
+    def _byte_ranges(self, response, length):
+        # the ranges to send, None for the whole file
+        header = self._req.headers.get('Range')
+        if header is None or self._req.method != 'GET':
+            return None
+        if_range = self._req.headers.get('If-Range')
+        if (if_range is not None and
+            if_range != response.headers['Last-Modified']):
+            # the file changed since the client got the first part
+            return None
+        byte_ranges = parse_ranges(header, length)
+        if byte_ranges is not None and len(byte_ranges) > MAX_RANGES:
+            return None
+        return byte_ranges
+
+    def _send_ranges(self, response, path, mimetype, length, byte_ranges,
+                     chunk_size):
+        response.status = 206
+        if len(byte_ranges) == 1:
+            start, stop = byte_ranges[0]
+            response.headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                start, stop - 1, length)
+            response.app_iter = FileIterable(path, start, stop, chunk_size)
+            response.content_length = stop - start
+            return response
+        boundary = uuid.uuid4().hex
+        response.content_type = 'multipart/byteranges; boundary=%s' % (
+            boundary)
+        response.app_iter = MultipartFileIterable(
+            path, mimetype, length, byte_ranges, boundary, chunk_size)
+        response.content_length = response.app_iter.content_length()
         return response
     
     def query_dict(self):
@@ -46,14 +112,83 @@ class WSGIRequest(object):
         args.update(dict(self._req.POST))
         return args
 
-    def write(self, data, mimetype):
-        """Write data back to the client
+    def write(self, data, mimetype, compress=False, etag=None):
+        """Write data back to the client, data is a string or an
+        iterable of strings that is sent while it is produced. With
+        compress the data is compressed with the best encoding the
+        client accepts.
         """
         response = Response()
         response.content_type = mimetype
-        response.body = data
+        wbits = None
+        if compress:
+            response.headers['Vary'] = 'Accept-Encoding'
+            encoding, wbits = self._accepted_compression()
+            if encoding is not None:
+                response.content_encoding = encoding
+        self._set_validators(response, etag, None, compress)
+        if isinstance(data, basestring):
+            if wbits is not None:
+                data = ''.join(compress_iter([data], wbits))
+            response.body = data
+        else:
+            if wbits is not None:
+                data = compress_iter(data, wbits)
+            response.app_iter = data
         return response
 
+    def not_modified(self, etag, last_modified=None, compress=False):
+        """Returns True if the client has the response with this
+        ETag or Last-Modified date
+        """
+        # webob makes If-None-Match: * a false value that contains
+        # every ETag
+        if 'If-None-Match' in self._req.headers:
+            return etag is not None and \
+                   self._variant_etag(etag, compress) in \
+                   self._req.if_none_match
+        if_modified_since = self._req.if_modified_since
+        if if_modified_since is None or last_modified is None:
+            return False
+        return (if_modified_since.replace(tzinfo=None) >=
+                last_modified.replace(microsecond=0))
+
+    def send_not_modified(self, etag, last_modified=None, compress=False):
+        """Tell the client to use the response it has
+        """
+        response = Response()
+        response.status = 304
+        del response.content_type
+        del response.content_length
+        if compress:
+            response.headers['Vary'] = 'Accept-Encoding'
+        self._set_validators(response, etag, last_modified, compress)
+        return response
+
+    def _set_validators(self, response, etag, last_modified, compress):
+        if etag is not None:
+            response.etag = self._variant_etag(etag, compress)
+        if last_modified is not None:
+            response.last_modified = last_modified
+
+    def _variant_etag(self, etag, compress):
+        # compressed responses are other bytes, so they need another
+        # strong ETag
+        if compress:
+            encoding = self._accepted_compression()[0]
+            if encoding is not None:
+                return '%s-%s' % (etag, encoding)
+        return etag
+
+    def _accepted_compression(self):
+        # without an Accept-Encoding header webob would accept all
+        # encodings, but only identity may be sent
+        if 'Accept-Encoding' not in self._req.headers:
+            return None, None
+        encoding = self._req.accept_encoding.best_match(
+            [name for name, wbits in COMPRESSION_WBITS])
+        return encoding, dict(COMPRESSION_WBITS).get(encoding)
+
     def send_status(self, code, msg='', mimetype='text/plain'):
         response = Response()
         response.content_type = mimetype
@@ -80,6 +215,15 @@ def app_factory(global_config,
                 formats,
                 **kwargs):
     # WSGI APP Factory
+    database = get_database(database, kwargs)
+    feedconfig = feed_config_factory(name, url, admin_email, formats,
+                                     **kwargs)
+    server = Server(url, database, feedconfig)
+    
+    return MOAIWSGIApp(server)
+
+def feed_config_factory(name, url, admin_email, formats, **kwargs):
+    # creates the FeedConfig from the settings of a moai app section
     formats = formats.split()
     admin_email = admin_email.split()
     sets_deleted = kwargs.get('deleted_sets') or []
@@ -94,35 +238,100 @@ def app_factory(global_config,
     sets_needed = kwargs.get('needed_sets', '') or []
     if sets_needed:
         sets_needed = sets_needed.split()
-    database = get_database(database, kwargs)
-    feedconfig = FeedConfig(name,
-                            url,
-                            admin_emails=admin_email,
-                            metadata_prefixes=formats,
-                            sets_deleted=sets_deleted,
-                            sets_disallowed=sets_disallowed,
-                            sets_allowed=sets_allowed,
-                            sets_needed=sets_needed,
-                            extra_args=kwargs)
-    server = Server(url, database, feedconfig)
-    
-    return MOAIWSGIApp(server)
+    return FeedConfig(name,
+                      url,
+                      admin_emails=admin_email,
+                      metadata_prefixes=formats,
+                      sets_deleted=sets_deleted,
+                      sets_disallowed=sets_disallowed,
+                      sets_allowed=sets_allowed,
+                      sets_needed=sets_needed,
+                      extra_args=kwargs)
+
+def parse_ranges(header, length):
+    """Returns the (start, stop) offsets of the byte ranges of a Range
+    header that are in a file of length bytes, or None if the header
+    is not valid"""
+    unit, sep, specs = header.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = [part.strip() for part in spec.partition('-')]
+        if (not sep or not (first or last) or
+            (first and not first.isdigit()) or
+            (last and not last.isdigit())):
+            return None
+        if not first:
+            # the last bytes of the file
+            start, stop = max(0, length - int(last)), length
+        elif not last:
+            start, stop = int(first), length
+        else:
+            start, stop = int(first), int(last) + 1
+            if stop <= start:
+                return None
+        if start < length and start < stop:
+            ranges.append((start, min(stop, length)))
+    return ranges
+
+def compress_iter(chunks, wbits):
+    # compresses an iterable of strings while it is produced, the
+    # compressor decides when it has enough data for a chunk
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 class FileIterable(object):
     # Helper objects to stream asset files
-    def __init__(self, filename, start=None, stop=None):
+    def __init__(self, filename, start=None, stop=None, chunk_size=None):
         self.filename = filename
         self.start = start
         self.stop = stop
+        self.chunk_size = chunk_size
     def __iter__(self):
-        return FileIterator(self.filename, self.start, self.stop)
+        return FileIterator(self.filename, self.start, self.stop,
+                            self.chunk_size)
     def app_iter_range(self, start, stop):
-        return self.__class__(self.filename, start, stop)
+        return self.__class__(self.filename, start, stop, self.chunk_size)
+
+class MultipartFileIterable(object):
+    # streams byte ranges of a file as a multipart/byteranges body
+    def __init__(self, filename, mimetype, length, ranges, boundary,
+                 chunk_size=None):
+        self.filename = filename
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        self.headers = ['\r\n--%s\r\n'
+                        'Content-Type: %s\r\n'
+                        'Content-Range: bytes %s-%s/%s\r\n\r\n' % (
+                            boundary, mimetype, start, stop - 1, length)
+                        for start, stop in ranges]
+        self.end = '\r\n--%s--\r\n' % boundary
+    def content_length(self):
+        return (sum([len(header) for header in self.headers]) +
+                sum([stop - start for start, stop in self.ranges]) +
+                len(self.end))
+    def __iter__(self):
+        for header, (start, stop) in zip(self.headers, self.ranges):
+            yield header
+            for chunk in FileIterator(self.filename, start, stop,
+                                      self.chunk_size):
+                yield chunk
+        yield self.end
 
 class FileIterator(object):
-    chunk_size = 4096
-    def __init__(self, filename, start, stop):
+    chunk_size = 65536
+    def __init__(self, filename, start, stop, chunk_size=None):
         self.filename = filename
+        if chunk_size:
+            self.chunk_size = chunk_size
         self.fileobj = open(self.filename, 'rb')
         if start:
             self.fileobj.seek(start)
@@ -133,14 +342,15 @@ class FileIterator(object):
     def __iter__(self):
         return self
     def next(self):
-        if self.length is not None and self.length <= 0:
-            raise StopIteration
-        chunk = self.fileobj.read(self.chunk_size)
+        size = self.chunk_size
+        if self.length is not None:
+            size = min(size, self.length)
+        chunk = ''
+        if size > 0:
+            chunk = self.fileobj.read(size)
         if not chunk:
+            self.fileobj.close()
             raise StopIteration
         if self.length is not None:
             self.length -= len(chunk)
-            if self.length < 0:
-                # Chop off the extra:
-                chunk = chunk[:self.length]
         return chunk
@@ -25,6 +25,7 @@ setup(
     entry_points= {
     'console_scripts': [
         'update_moai = moai.tools:update_moai',
+        'migrate_moai = moai.tools:migrate_moai',
       ],
     'paste.app_factory':[
         'main=moai.wsgi:app_factory'
@@ -43,6 +44,10 @@ setup(
         'oai=moai.provider.oai:OAIBasedContentProvider',
         'fedora=moai.provider.feadora:FedoraBasedContentProvider'
      ],
+    'moai.codec':[
+        'json=moai.codec:JSONCodec',
+        'zlib=moai.codec:ZlibCodec'
+     ],
     'moai.format':[
          'oai_dc=moai.metadata.oaidc:OAIDC',
          'mods=moai.metadata.mods:MODS',